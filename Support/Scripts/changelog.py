@@ -5,14 +5,27 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import requests
+import copy
+import hashlib
 import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from optparse import OptionParser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configuration
-MD_URL = 'https://jirahub.int.agrd.dev/v1/release_notes/changelog.md'
-TXT_URL = 'https://jirahub.int.agrd.dev/v1/release_notes/changelog.txt'
+API_URL = 'https://jirahub.int.agrd.dev/v1/release_notes'
+MD_PATH = 'changelog.md'
+TXT_PATH = 'changelog.txt'
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 1
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DOWNLOAD_WORKERS = 2
+MAX_DOWNLOAD_WORKERS = 8
 
 CHANGELOG_NAME = "changelog.md"
 BUILD_JSON_NAME = "build.json"
@@ -37,6 +50,17 @@ def get_args():
                       help="Version that we will put to build.json")
     parser.add_option("-c", "--channel", dest="channel",
                       help="Update channel (can be nightly, beta or release)")
+    parser.add_option("--api-url", dest="api_url", default=API_URL,
+                      help="Release notes service URL")
+    parser.add_option("--cache-dir", dest="cache_dir",
+                      help="Path to the directory where downloaded release notes are cached by ETag")
+    parser.add_option("--timeout", dest="timeout", type="float", default=DEFAULT_TIMEOUT,
+                      help="Timeout of a single request in seconds")
+    parser.add_option("--retries", dest="retries", type="int", default=DEFAULT_RETRIES,
+                      help="Number of retries of a failed request")
+    parser.add_option("-m", "--manifest", dest="manifest",
+                      help="Path to a JSON list of {version, channel, from, output} objects to render in one run, "
+                           "replaces --version, --channel, --from and --output")
 
     # pylint: disable=unused-variable
     (options, args) = parser.parse_args()
@@ -47,37 +71,126 @@ def get_args():
     if not options.gh_repo:
         parser.error("GitHub repo is not specified")
 
-    if not options.output:
-        parser.error("Output path is not specified")
+    if not options.manifest:
+        if not options.output:
+            parser.error("Output path is not specified")
 
-    if not options.version:
-        parser.error("Version is not specified")
+        if not options.version:
+            parser.error("Version is not specified")
 
-    if not options.channel:
-        parser.error("Channel is not specified")
+        if not options.channel:
+            parser.error("Channel is not specified")
 
     # Locations are relative to this python file location
-    options.output = os.path.join(CURRENT_DIR, options.output)
+    if options.output:
+        options.output = os.path.join(CURRENT_DIR, options.output)
+    if options.cache_dir:
+        options.cache_dir = os.path.join(CURRENT_DIR, options.cache_dir)
+    if options.manifest:
+        options.manifest = os.path.join(CURRENT_DIR, options.manifest)
 
     print('Args are: %s' % options)
     return options
 
 
-def download(url, params):
+def read_manifest(args):
+    """Returns options for every output listed in the manifest, shared options are taken from args"""
+    with open(args.manifest, "r") as file:
+        manifest = json.load(file)
+
+    if not manifest:
+        raise ValueError("The manifest has no entries: {0}".format(args.manifest))
+
+    entries = []
+    for item in manifest:
+        for key in ("version", "channel", "output"):
+            if not item.get(key):
+                raise ValueError("'{0}' is not specified in the manifest entry: {1}".format(key, item))
+
+        entry = copy.copy(args)
+        entry.version = item["version"]
+        entry.channel = item["channel"]
+        entry.from_ref = item.get("from")
+        entry.output = os.path.join(CURRENT_DIR, item["output"])
+        entries.append(entry)
+
+    return entries
+
+
+def create_session(retries, pool_size=DOWNLOAD_WORKERS):
+    """Creates a session which reuses connections and retries failed requests with a backoff"""
+    retry = Retry(
+        total=retries,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_size)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_request_key(url, params):
+    return json.dumps([url, sorted(params.items())])
+
+
+def get_cache_path(cache_dir, url, params):
+    key = get_request_key(url, params)
+    return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.json')
+
+
+def read_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+
+    with open(cache_path, "r") as file:
+        return json.load(file)
+
+
+def write_cache(cache_path, etag, text):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    # Write to a temporary file first, so a concurrent run never reads a partial entry
+    tmp_path = "{0}.{1}.tmp".format(cache_path, os.getpid())
+    with open(tmp_path, "w") as file:
+        json.dump({"etag": etag, "text": text}, file)
+    os.replace(tmp_path, cache_path)
+
+
+def download(session, url, params, args):
     print("Downloading {0} with params:\n{1}".format(url, params))
 
-    result = requests.get(url, params=params)
+    cache_path = None
+    cached = None
+    headers = {}
+    if args.cache_dir:
+        cache_path = get_cache_path(args.cache_dir, url, params)
+        cached = read_cache(cache_path)
+        if cached:
+            headers['If-None-Match'] = cached['etag']
+
+    result = session.get(url, params=params, headers=headers, timeout=args.timeout)
     print(result.request.url)
+
+    if result.status_code == 304 and cached:
+        print("Not modified, using cached {0}".format(url))
+        return cached['text']
+
     if result.status_code != 200:
         raise ConnectionError("Could not download. Response status={0}\n{1}".format(result.status_code, result.text))
 
-    print("Downloaded {0}".format(url))
-    return result
+    etag = result.headers.get('ETag')
+    if cache_path and etag:
+        write_cache(cache_path, etag, result.text)
 
+    print("Downloaded {0}".format(url))
+    return result.text
 
-def write_md_changelog(args):
-    changelog_path = os.path.join(args.output, CHANGELOG_NAME)
 
+def get_md_params(args):
     params = {
         'repo': args.repo,
         'github_repo': args.gh_repo
@@ -85,7 +198,23 @@ def write_md_changelog(args):
     if args.from_ref and len(args.from_ref):
         params['from_ref'] = args.from_ref
 
-    result = download(MD_URL, params).text
+    return params
+
+
+def get_json_params(args):
+    params = {
+        'repo': args.repo,
+        'github_repo': args.gh_repo,
+        'private': 'false'
+    }
+    if args.from_ref and len(args.from_ref):
+        params['from_ref'] = args.from_ref
+
+    return params
+
+
+def write_md_changelog(args, result):
+    changelog_path = os.path.join(args.output, CHANGELOG_NAME)
 
     with open(changelog_path, "w") as file:
 
@@ -96,19 +225,9 @@ def write_md_changelog(args):
     print("Changelog has been written to {0}".format(changelog_path))
 
 
-def write_json_changelog(args):
+def write_json_changelog(args, result):
     build_json_path = os.path.join(args.output, BUILD_JSON_NAME)
 
-    params = {
-        'repo': args.repo,
-        'github_repo': args.gh_repo,
-        'private': 'false'
-    }
-    if args.from_ref and len(args.from_ref):
-        params['from_ref'] = args.from_ref
-
-    result = download(TXT_URL, params).text
-
     build = {
         "version": args.version,
         "platform": BUILD_JSON_PLATFORM,
@@ -123,15 +242,55 @@ def write_json_changelog(args):
 
     print("Changelog has been written to {0}".format(build_json_path))
 
+def collect_changelogs(args, entries):
+    """Downloads every unique release notes query once and renders all outputs from the results"""
+    md_url = "{0}/{1}".format(args.api_url, MD_PATH)
+    txt_url = "{0}/{1}".format(args.api_url, TXT_PATH)
+
+    downloads = {}
+    requests_by_entry = []
+    for entry in entries:
+        md_key = get_request_key(md_url, get_md_params(entry))
+        txt_key = get_request_key(txt_url, get_json_params(entry))
+        downloads.setdefault(md_key, (md_url, get_md_params(entry)))
+        downloads.setdefault(txt_key, (txt_url, get_json_params(entry)))
+        requests_by_entry.append((entry, md_key, txt_key))
+
+    if not downloads:
+        print("Nothing to download")
+        return
+
+    print("Downloading {0} unique release notes for {1} outputs".format(len(downloads), len(entries)))
+
+    workers = max(1, min(MAX_DOWNLOAD_WORKERS, len(downloads)))
+    session = create_session(args.retries, workers)
+
+    # Downloads run concurrently over the same connection pool
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            key: executor.submit(download, session, url, params, args)
+            for key, (url, params) in downloads.items()
+        }
+
+        for entry, md_key, txt_key in requests_by_entry:
+            write_md_changelog(entry, futures[md_key].result())
+            write_json_changelog(entry, futures[txt_key].result())
+
+
 def main():
     print("Start collecting release notes")
     args = get_args()
 
-    write_md_changelog(args)
-    write_json_changelog(args)
+    if args.manifest:
+        entries = read_manifest(args)
+    else:
+        entries = [args]
+
+    collect_changelogs(args, entries)
 
     print("The changelog has been successfully collected")
 
 
 # Entry point
-main()
+if __name__ == "__main__":
+    main()
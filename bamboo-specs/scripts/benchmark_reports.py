@@ -0,0 +1,396 @@
+# SPDX-FileCopyrightText: AdGuard Software Limited
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+DEFAULT_ENCODING = "UTF-8"
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+REPO_ROOT = SCRIPTS_DIR.parent.parent
+CHANGELOG_SCRIPT = REPO_ROOT / "Support" / "Scripts" / "changelog.py"
+
+DEFAULT_SEED = 42
+DEFAULT_LINTER_SIZES = "10000,100000"
+DEFAULT_LINTER_JOBS = "2,4,8"
+DEFAULT_REUSE_SIZES = "1000,10000"
+DEFAULT_APPCAST_SIZES = "100,5000"
+DEFAULT_CHANGELOG_SIZES = "1,4"
+
+# Violations of one file are reported together, as swiftlint does
+VIOLATIONS_PER_FILE = 25
+
+SWIFTLINT_RULES = [
+    ("line_length", "Line Length", "Line should be 120 characters or less; currently it has {0} characters"),
+    ("file_length", "File Length", "File should contain 400 lines or less: currently contains {0}"),
+    ("todo_jira", "Todo Jira", "TODOs should be linked to a Jira issue, found {0}"),
+    ("identifier_name", "Identifier Name", "Variable name 'x{0}' should be between 3 and 40 characters long"),
+    ("force_cast", "Force Cast", "Force casts should be avoided, found {0}"),
+]
+
+APPCAST_CHANNELS = ["nightly", "beta", "release", None]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmark report and release scripts on synthetic inputs.")
+
+    parser.add_argument(
+        "--output-path",
+        type=Path,
+        dest="output_path",
+        required=True,
+        help="Path to the JSON file with benchmark results",
+    )
+
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        dest="work_dir",
+        help="Directory for generated inputs and outputs. A temporary one is used by default",
+    )
+
+    parser.add_argument(
+        "--scripts",
+        dest="scripts",
+        default="linter,reuse,appcast,changelog",
+        help="Comma-separated list of benchmarked scripts",
+    )
+
+    parser.add_argument("--linter-sizes", dest="linter_sizes", default=DEFAULT_LINTER_SIZES, help="Numbers of swiftlint violations")
+    parser.add_argument("--linter-jobs", dest="linter_jobs", default=DEFAULT_LINTER_JOBS, help="Numbers of linter processes")
+    parser.add_argument("--reuse-sizes", dest="reuse_sizes", default=DEFAULT_REUSE_SIZES, help="Numbers of non-compliant files")
+    parser.add_argument("--appcast-sizes", dest="appcast_sizes", default=DEFAULT_APPCAST_SIZES, help="Numbers of appcast items")
+    parser.add_argument("--changelog-sizes", dest="changelog_sizes", default=DEFAULT_CHANGELOG_SIZES, help="Numbers of changelog outputs")
+
+    parser.add_argument("--seed", type=int, dest="seed", default=DEFAULT_SEED, help="Seed of input generators")
+    parser.add_argument("--repeat", type=int, dest="repeat", default=1, help="Number of runs of every case, the fastest one is reported")
+
+    return parser.parse_args()
+
+
+def parse_sizes(sizes: str):
+    return [int(size) for size in sizes.split(",") if size]
+
+
+def generate_swiftlint_report(path_: Path, root_path: Path, count: int, seed: int) -> None:
+    """Writes a swiftlint JSON report with `count` violations."""
+    rng = random.Random(seed)
+    files_count = max(1, count // VIOLATIONS_PER_FILE)
+
+    with open(path_, mode="w", encoding=DEFAULT_ENCODING) as f:
+        f.write("[\n")
+        for index in range(count):
+            rule_id, rule_type, reason = SWIFTLINT_RULES[rng.randrange(len(SWIFTLINT_RULES))]
+            file_index = index * files_count // count
+            violation = {
+                "character": rng.choice([None, rng.randint(1, 120)]),
+                "file": str(root_path / f"Module{file_index % 16}" / "Sources" / f"File{file_index}.swift"),
+                "line": rng.randint(1, 2000),
+                "reason": reason.format(rng.randint(121, 500)),
+                "rule_id": rule_id,
+                "severity": rng.choice(["Warning", "Error"]),
+                "type": rule_type,
+            }
+            if index:
+                f.write(",\n")
+            f.write(json.dumps(violation, indent=2))
+        f.write("\n]\n")
+
+
+def generate_reuse_report(path_: Path, count: int, seed: int) -> None:
+    """Writes a REUSE lint JSON report with `count` non-compliant files spread over every category."""
+    rng = random.Random(seed)
+    files = [f"Sources/Module{index % 16}/File{index}.swift" for index in range(count)]
+
+    non_compliant = {
+        "bad_licenses": {"GPL-3.0-or-lateer": rng.sample(files, count // 50)},
+        "deprecated_licenses": ["GPL-3.0", "LGPL-2.1"],
+        "licenses_without_extension": {},
+        "missing_licenses": {"MIT": rng.sample(files, count // 40)},
+        "unused_licenses": [],
+        "read_errors": rng.sample(files, count // 100),
+        "missing_licensing_info": rng.sample(files, count // 2),
+        "missing_copyright_info": rng.sample(files, count // 2),
+    }
+
+    report = {
+        "lint_version": "1.0",
+        "reuse_spec_version": "3.3",
+        "reuse_version": "5.0.2",
+        "non_compliant": non_compliant,
+        "files": [],
+        "summary": {"compliant": False},
+    }
+
+    with open(path_, mode="w", encoding=DEFAULT_ENCODING) as f:
+        json.dump(report, f, indent=2)
+
+
+def generate_appcast(path_: Path, count: int, seed: int, start_version: int = 0) -> None:
+    """Writes a Sparkle appcast with `count` items across channels, sorted by pubDate as update_appcast.py does."""
+    rng = random.Random(seed)
+    start_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    minutes = sorted((rng.randint(0, 3_000_000) for _ in range(count)), reverse=True)
+
+    with open(path_, mode="w", encoding=DEFAULT_ENCODING) as f:
+        f.write('<?xml version="1.0" standalone="yes"?>\n')
+        f.write('<rss xmlns:sparkle="http://www.andymatuschak.org/xml-namespaces/sparkle" version="2.0">\n')
+        f.write("    <channel>\n")
+        f.write("        <title>AdGuard Mini</title>\n")
+        for index in range(count):
+            version = start_version + index
+            channel = rng.choice(APPCAST_CHANNELS)
+            pubdate = start_date + timedelta(minutes=minutes[index])
+            f.write("        <item>\n")
+            f.write(f"            <title>2.{version}</title>\n")
+            f.write(f"            <pubDate>{format_datetime(pubdate)}</pubDate>\n")
+            f.write(f"            <sparkle:version>{version}</sparkle:version>\n")
+            if channel:
+                f.write(f"            <sparkle:channel>{channel}</sparkle:channel>\n")
+            f.write(
+                "            <sparkle:releaseNotesLink><![CDATA["
+                f"https://link.adtidy.org/forward.html?app=mac-mini&v={version}&channel={channel}"
+                "]]></sparkle:releaseNotesLink>\n"
+            )
+            f.write(
+                f'            <enclosure url="https://static.adtidy.org/mac/AdGuardMini-2.{version}.app.zip" '
+                f'length="{rng.randint(10 ** 7, 10 ** 8)}" type="application/octet-stream" '
+                'sparkle:edSignature="c2lnbmF0dXJl"/>\n'
+            )
+            f.write("        </item>\n")
+        f.write("    </channel>\n")
+        f.write("</rss>\n")
+
+
+class ChangelogStubHandler(BaseHTTPRequestHandler):
+    """Serves release notes for any query, as the release notes service does."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = f"* Release notes for {self.path}\n".encode(DEFAULT_ENCODING)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ChangelogStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_max_rss_bytes(rusage) -> int:
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return rusage.ru_maxrss
+    return rusage.ru_maxrss * 1024
+
+
+def run_script(command: list) -> dict:
+    """Runs a script in a separate process and returns its wall time and peak memory."""
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode:
+        raise RuntimeError(f"Benchmarked command failed with code {process.returncode}: {' '.join(map(str, command))}")
+
+    return {"wall_time": wall_time, "peak_rss": get_max_rss_bytes(rusage)}
+
+
+def benchmark(name: str, size: int, command: list, repeat: int, prepare=None) -> dict:
+    """Runs a case `repeat` times and keeps the fastest run."""
+    runs = []
+    for _ in range(repeat):
+        if prepare:
+            prepare()
+        runs.append(run_script(command))
+
+    best = min(runs, key=lambda run: run["wall_time"])
+    result = {
+        "name": name,
+        "size": size,
+        "wall_time": round(best["wall_time"], 4),
+        "peak_rss": best["peak_rss"],
+        "throughput": round(size / best["wall_time"], 1),
+    }
+    logging.info(
+        f"{name} [{size}]: {result['wall_time']} s, {result['peak_rss'] // (1024 * 1024)} MB, "
+        f"{result['throughput']} items/s"
+    )
+    return result
+
+
+def get_linter_cases(work_dir: Path, sizes: list, jobs: list, seed: int):
+    root_path = work_dir / "repo"
+    root_path.mkdir(exist_ok=True)
+
+    for size in sizes:
+        report_path = work_dir / f"swiftlint_{size}.json"
+        generate_swiftlint_report(report_path, root_path, size, seed)
+        base_command = [
+            sys.executable,
+            SCRIPTS_DIR / "create_linter_report.py",
+            "--report-path", report_path,
+            "--root-path", root_path,
+            "--report-output-path", work_dir / "linter_insight_report.json",
+            "--annotations-output-path", work_dir / "linter_annotations.json",
+        ]
+        yield "create_linter_report", size, base_command, None
+        yield "create_linter_report --stream", size, base_command + ["--stream"], None
+        for jobs_count in jobs:
+            yield f"create_linter_report --jobs {jobs_count}", size, base_command + ["--jobs", str(jobs_count)], None
+
+
+def get_reuse_cases(work_dir: Path, sizes: list, seed: int):
+    for size in sizes:
+        report_path = work_dir / f"reuse_{size}.json"
+        generate_reuse_report(report_path, size, seed)
+        command = [
+            sys.executable,
+            SCRIPTS_DIR / "create_reuse_report.py",
+            "--report-path", report_path,
+            "--report-output-path", work_dir / "reuse_insight_report.json",
+            "--annotations-output-path", work_dir / "reuse_annotations.json",
+        ]
+        yield "create_reuse_report", size, command, None
+
+
+def get_appcast_cases(work_dir: Path, sizes: list, seed: int):
+    source_path = work_dir / "appcast_source.xml"
+    generate_appcast(source_path, len(APPCAST_CHANNELS), seed + 1, start_version=10 ** 6)
+
+    for size in sizes:
+        original_path = work_dir / f"appcast_{size}.xml"
+        target_path = work_dir / "appcast_target.xml"
+        generate_appcast(original_path, size, seed)
+
+        # The script updates the target in place, so every run starts from the same feed
+        def prepare(original_path=original_path, target_path=target_path):
+            target_path.write_bytes(original_path.read_bytes())
+
+        command = [
+            sys.executable,
+            SCRIPTS_DIR / "update_appcast.py",
+            "--source-path", source_path,
+            "--target-path", target_path,
+        ]
+        yield "update_appcast", size, command, prepare
+        yield "update_appcast --stream", size, command + ["--stream"], prepare
+
+
+def get_changelog_cases(work_dir: Path, sizes: list, api_url: str):
+    for size in sizes:
+        manifest = []
+        for index in range(size):
+            output = work_dir / f"changelog_{index}"
+            output.mkdir(exist_ok=True)
+            manifest.append(
+                {
+                    "version": f"2.{index}",
+                    "channel": APPCAST_CHANNELS[index % 3],
+                    "from": f"v2.{index // 2}",
+                    "output": str(output),
+                }
+            )
+
+        manifest_path = work_dir / f"changelog_manifest_{size}.json"
+        with open(manifest_path, mode="w", encoding=DEFAULT_ENCODING) as f:
+            json.dump(manifest, f)
+
+        command = [
+            sys.executable,
+            CHANGELOG_SCRIPT,
+            "--repo", "SCITER/adguard-mini",
+            "--gh-repo", "AdguardTeam/AdGuardForSafari",
+            "--api-url", api_url,
+            "--manifest", manifest_path,
+        ]
+        yield "changelog", size, command, None
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args, work_dir: Path) -> list:
+    scripts = set(args.scripts.split(","))
+    cases = []
+
+    if "linter" in scripts:
+        cases.extend(get_linter_cases(work_dir, parse_sizes(args.linter_sizes), parse_sizes(args.linter_jobs), args.seed))
+
+    if "reuse" in scripts:
+        cases.extend(get_reuse_cases(work_dir, parse_sizes(args.reuse_sizes), args.seed))
+
+    if "appcast" in scripts:
+        cases.extend(get_appcast_cases(work_dir, parse_sizes(args.appcast_sizes), args.seed))
+
+    server = None
+    if "changelog" in scripts:
+        server = start_stub_server()
+        api_url = f"http://127.0.0.1:{server.server_address[1]}/v1/release_notes"
+        cases.extend(get_changelog_cases(work_dir, parse_sizes(args.changelog_sizes), api_url))
+
+    try:
+        return [benchmark(name, size, command, args.repeat, prepare) for name, size, command, prepare in cases]
+    finally:
+        if server:
+            server.shutdown()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = get_args()
+
+    if args.work_dir:
+        args.work_dir.mkdir(parents=True, exist_ok=True)
+        results = run_benchmarks(args, args.work_dir)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_benchmarks(args, Path(work_dir))
+
+    output = {
+        "revision": get_git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "results": results,
+    }
+
+    with open(args.output_path, mode="w", encoding=DEFAULT_ENCODING) as f:
+        json.dump(output, f, indent=2)
+
+    logging.info(f"Benchmark results are saved to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,8 @@ COMMIT_ID="$3"
 TOKEN="$4"
 BUILD_PATH_ARG="$5"
 BITBUCKET_KIT_ARG="$6"
+# Optional git revision, e.g. the PR target branch. If set, only files and lines changed since it are linted
+DIFF_BASE="$7"
 
 if [ -z "$PROJECT_KEY" ]; then
       echo "PROJECT_KEY is not provided"
@@ -81,10 +83,20 @@ fi
 SWIFTLINT_ZIP_PATH="$BUILD_PATH/portable_swiftlint.zip"
 PATH_TO_SWIFTLINT="$BUILD_PATH/swiftlint"
 OUTPUT_REPORT="$BUILD_PATH/swiftlint_result.json"
-PROCESSED_BASE_REPORT="$BUILD_PATH/insight_report.json"
-PROCESSED_ANNOTATIONS_REPORT="$BUILD_PATH/annotations.json"
+PROCESSED_SHARDS_PATH="$BUILD_PATH/insight_shards"
+# Phase timings and counters of the report conversion
+METRICS_PATH="$BUILD_PATH/swiftlint_metrics.json"
 
 INSIGHT_KEY="com.agduard.mac.adguardMini.swiftlint"
+# Processed reports are reused by reruns on the same agent
+CACHE_PATH="${HOME}/.cache/adguard-mini/insight_reports"
+
+# Optional Bitbucket server URL. If set, the converter uploads the reports itself instead of bitbucket-kit
+UPLOAD_ARGS=()
+if [ -n "$BITBUCKET_URL" ]; then
+    export BITBUCKET_TOKEN="$TOKEN"
+    UPLOAD_ARGS=(--upload-url "$BITBUCKET_URL" --project-key "$PROJECT_KEY" --repository "$REPOSITORY_NAME" --commit-id "$COMMIT_ID")
+fi
 
 STEP=0
 step_msg() { ((++STEP)); echo "Step $STEP:" "$@"; }
@@ -95,40 +107,89 @@ unzip -o $SWIFTLINT_ZIP_PATH -d $BUILD_PATH
 
 step_msg "Create swiftlint report"
 
-$PATH_TO_SWIFTLINT lint \
-    --config $PATH_TO_CONFIG_FILE \
-    --working-directory $PATH_TO_ANALYSE \
-    --reporter json \
-    --output $OUTPUT_REPORT \
-    --quiet \
-    || true
+LINT_PATHS=()
+CHANGES_ARGS=()
+if [ -n "$DIFF_BASE" ]; then
+    # Lint only Swift files changed since DIFF_BASE, the converter then keeps violations on changed lines
+    # Names are NUL-separated, so paths with spaces, quotes or non-ASCII characters are read as they are
+    while IFS= read -r -d '' changed_file; do
+        LINT_PATHS+=("$(realpath "$changed_file")")
+    done < <(git -c core.quotePath=false diff -z --name-only --diff-filter=d --relative "$DIFF_BASE" -- "$PATH_TO_ANALYSE/*.swift")
+    CHANGES_ARGS=(--diff-base "$DIFF_BASE")
+    echo "Changed swift files since $DIFF_BASE: ${#LINT_PATHS[@]}"
+fi
+
+if [ -n "$DIFF_BASE" ] && [ ${#LINT_PATHS[@]} -eq 0 ]; then
+    echo "[]" > $OUTPUT_REPORT
+else
+    $PATH_TO_SWIFTLINT lint \
+        --config $PATH_TO_CONFIG_FILE \
+        --working-directory $PATH_TO_ANALYSE \
+        --reporter json \
+        --output $OUTPUT_REPORT \
+        --quiet \
+        --force-exclude \
+        "${LINT_PATHS[@]}" \
+        || true
+fi
 
 step_msg "Create bitbucket insights reports"
 
 python3 bamboo-specs/scripts/create_linter_report.py \
     --report-path $OUTPUT_REPORT \
     --root-path . \
-    --report-output-path $PROCESSED_BASE_REPORT \
-    --annotations-output-path $PROCESSED_ANNOTATIONS_REPORT
+    --shards-dir $PROCESSED_SHARDS_PATH \
+    --insight-key $INSIGHT_KEY \
+    --stream \
+    --cache-dir "$CACHE_PATH" \
+    --metrics-path "$METRICS_PATH" \
+    "${UPLOAD_ARGS[@]}" \
+    "${CHANGES_ARGS[@]}"
+
+if [ -n "$BITBUCKET_URL" ]; then
+    echo "Reports are uploaded by the converter"
+    exit 0
+fi
 
-step_msg "Send base report"
+# Sends a base report and its annotations, reports are split by the Bitbucket annotations limit
+send_shard() {
+    local insight_key="$1"
+    local report="$2"
+    local annotations="$3"
+    local annotations_count="$4"
+
+    python3 $PATH_TO_BITBUCKET_KIT \
+        createBaseReport \
+        -t $TOKEN \
+        -p $PROJECT_KEY \
+        -r $REPOSITORY_NAME \
+        --commit-id $COMMIT_ID \
+        --insight-key "$insight_key" \
+        --report "$report"
+
+    if [ "$annotations_count" -eq 0 ]; then
+        echo "No annotations to send for $insight_key. Skipping createAnnotations."
+        return 0
+    fi
 
-python3 $PATH_TO_BITBUCKET_KIT \
-    createBaseReport \
-    -t $TOKEN \
-    -p $PROJECT_KEY \
-    -r $REPOSITORY_NAME \
-    --commit-id $COMMIT_ID \
-    --insight-key $INSIGHT_KEY \
-    --report $PROCESSED_BASE_REPORT
+    python3 $PATH_TO_BITBUCKET_KIT \
+        createAnnotations \
+        -t $TOKEN \
+        -p $PROJECT_KEY \
+        -r $REPOSITORY_NAME \
+        --commit-id $COMMIT_ID \
+        --insight-key "$insight_key" \
+        --annotations "$annotations"
+}
 
-step_msg "Send annotations"
+step_msg "Send base reports and annotations"
 
-python3 $PATH_TO_BITBUCKET_KIT \
-    createAnnotations \
-    -t $TOKEN \
-    -p $PROJECT_KEY \
-    -r $REPOSITORY_NAME \
-    --commit-id $COMMIT_ID \
-    --insight-key $INSIGHT_KEY \
-    --annotations $PROCESSED_ANNOTATIONS_REPORT
+PIDS=()
+while IFS=$'\t' read -r insight_key report annotations annotations_count; do
+    send_shard "$insight_key" "$PROCESSED_SHARDS_PATH/$report" "$PROCESSED_SHARDS_PATH/$annotations" "$annotations_count" &
+    PIDS+=($!)
+done < <(jq -r '.shards[] | [.insight_key, .report, .annotations, .annotations_count] | @tsv' "$PROCESSED_SHARDS_PATH/shards.json")
+
+for pid in "${PIDS[@]}"; do
+    wait "$pid"
+done
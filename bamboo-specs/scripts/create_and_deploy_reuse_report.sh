@@ -45,10 +45,20 @@ if [ -z "$PATH_TO_BITBUCKET_KIT" ]; then
 fi
 
 OUTPUT_REPORT="$BUILD_PATH/reuse_result.json"
-PROCESSED_BASE_REPORT="$BUILD_PATH/insight_report.json"
-PROCESSED_ANNOTATIONS_REPORT="$BUILD_PATH/annotations.json"
+PROCESSED_SHARDS_PATH="$BUILD_PATH/insight_shards"
+# Phase timings and counters of the report conversion
+METRICS_PATH="$BUILD_PATH/reuse_metrics.json"
 
 INSIGHT_KEY="com.adguard.mac.adguardMini.reuse"
+# Processed reports are reused by reruns on the same agent
+CACHE_PATH="${HOME}/.cache/adguard-mini/insight_reports"
+
+# Optional Bitbucket server URL. If set, the converter uploads the reports itself instead of bitbucket-kit
+UPLOAD_ARGS=()
+if [ -n "$BITBUCKET_URL" ]; then
+    export BITBUCKET_TOKEN="$TOKEN"
+    UPLOAD_ARGS=(--upload-url "$BITBUCKET_URL" --project-key "$PROJECT_KEY" --repository "$REPOSITORY_NAME" --commit-id "$COMMIT_ID")
+fi
 
 STEP=0
 step_msg() { ((++STEP)); echo "Step $STEP:" "$@"; }
@@ -70,30 +80,56 @@ step_msg "Create bitbucket insights reports"
 
 python bamboo-specs/scripts/create_reuse_report.py \
     --report-path $OUTPUT_REPORT \
-    --report-output-path $PROCESSED_BASE_REPORT \
-    --annotations-output-path $PROCESSED_ANNOTATIONS_REPORT
+    --shards-dir $PROCESSED_SHARDS_PATH \
+    --insight-key $INSIGHT_KEY \
+    --cache-dir "$CACHE_PATH" \
+    --metrics-path "$METRICS_PATH" \
+    "${UPLOAD_ARGS[@]}"
 
-step_msg "Send base report"
+if [ -n "$BITBUCKET_URL" ]; then
+    echo "Reports are uploaded by the converter"
+    exit 0
+fi
 
-python $PATH_TO_BITBUCKET_KIT \
-    createBaseReport \
-    -t $TOKEN \
-    -p $PROJECT_KEY \
-    -r $REPOSITORY_NAME \
-    --commit-id $COMMIT_ID \
-    --insight-key $INSIGHT_KEY \
-    --report $PROCESSED_BASE_REPORT
+# Sends a base report and its annotations, reports are split by the Bitbucket annotations limit
+send_shard() {
+    local insight_key="$1"
+    local report="$2"
+    local annotations="$3"
+    local annotations_count="$4"
+
+    python $PATH_TO_BITBUCKET_KIT \
+        createBaseReport \
+        -t $TOKEN \
+        -p $PROJECT_KEY \
+        -r $REPOSITORY_NAME \
+        --commit-id $COMMIT_ID \
+        --insight-key "$insight_key" \
+        --report "$report"
+
+    if [ "$annotations_count" -eq 0 ]; then
+        echo "No annotations to send for $insight_key. Skipping createAnnotations."
+        return 0
+    fi
 
-step_msg "Send annotations"
-if [ "$(jq -r '.annotations | length' "$PROCESSED_ANNOTATIONS_REPORT")" -eq 0 ]; then
-    echo "No annotations to send. Skipping createAnnotations."
-else
     python $PATH_TO_BITBUCKET_KIT \
         createAnnotations \
         -t $TOKEN \
         -p $PROJECT_KEY \
         -r $REPOSITORY_NAME \
         --commit-id $COMMIT_ID \
-        --insight-key $INSIGHT_KEY \
-        --annotations $PROCESSED_ANNOTATIONS_REPORT
-fi
+        --insight-key "$insight_key" \
+        --annotations "$annotations"
+}
+
+step_msg "Send base reports and annotations"
+
+PIDS=()
+while IFS=$'\t' read -r insight_key report annotations annotations_count; do
+    send_shard "$insight_key" "$PROCESSED_SHARDS_PATH/$report" "$PROCESSED_SHARDS_PATH/$annotations" "$annotations_count" &
+    PIDS+=($!)
+done < <(jq -r '.shards[] | [.insight_key, .report, .annotations, .annotations_count] | @tsv' "$PROCESSED_SHARDS_PATH/shards.json")
+
+for pid in "${PIDS[@]}"; do
+    wait "$pid"
+done
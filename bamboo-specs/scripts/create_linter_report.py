@@ -3,14 +3,81 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import argparse
+import bisect
+import fnmatch
+import glob
+import heapq
 import json
 import logging
 import os
+import re
+import subprocess
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from types import SimpleNamespace
 
-DEFAULT_ENCODING = "UTF-8"
+from report_common import (
+    DEFAULT_CACHE_MAX_SIZE_MB,
+    DEFAULT_ENCODING,
+    AnnotationsWriter,
+    Metrics,
+    ReportCache,
+    ShardedAnnotationsWriter,
+    add_metrics_args,
+    dumps_compact,
+    get_mp_context,
+    load_json,
+    restore_cached,
+    store_cached,
+    write_insight_reports,
+)
+from report_uploader import InsightsUploader, add_upload_args, build_uploads, get_uploader, load_uploads
+from report_writers import OutputWriters, add_output_args
+
+# Size of a chunk read from the swiftlint report in the streaming mode
+READ_CHUNK_SIZE = 1024 * 1024
+
+WHITESPACE_REGEX = re.compile(r"[ \t\n\r]*")
+
+# Numbers in a violation reason (e.g. current line length) change without a new violation
+DIGITS_REGEX = re.compile(r"\d+")
+SPACES_REGEX = re.compile(r"\s+")
+
+# Hunk header of a unified diff: @@ -1,2 +3,4 @@
+HUNK_HEADER_REGEX = re.compile(r"^@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+# Escapes of a path quoted by git in the C style, octal escapes are bytes of the UTF-8 encoded path
+GIT_PATH_ESCAPE_REGEX = re.compile(rb"\\([0-7]{3}|.)")
+GIT_PATH_ESCAPES = {
+    b"a": b"\a",
+    b"b": b"\b",
+    b"t": b"\t",
+    b"n": b"\n",
+    b"v": b"\v",
+    b"f": b"\f",
+    b"r": b"\r",
+    b'"': b'"',
+    b"\\": b"\\",
+}
+
+# Global inline flags at the start of a severity config regex, e.g. (?i). They are not allowed inside the combined
+# regex, so they are turned into a scoped group of the entry
+GLOBAL_FLAGS_REGEX = re.compile(r"\A(?:\(\?[aiLmsux]+\))+")
+
+# Number of distinct file paths resolved against the repo root that are kept in memory
+PATH_CACHE_SIZE = 65536
+
+# Critical violations logged one by one, the rest are only counted, as logging would cost more than the processing
+MAX_LOGGED_CRITICAL_VIOLATIONS = 1000
+
+# Number of violations converted by a worker of --jobs at once
+JOB_CHUNK_SIZE = 5000
+
+# Chunks submitted to workers ahead of the one being written, per worker
+JOB_CHUNKS_AHEAD = 2
 
 
 class Severity(str, Enum):
@@ -19,14 +86,25 @@ class Severity(str, Enum):
     HIGH = "HIGH"
 
 
-RULE_SEVERITY_MAP = {
-    "file_length": Severity.LOW,
-    "todo_jira": Severity.MEDIUM,
-    "": Severity.HIGH,
+# Severity config used without --severity-config. Config keys:
+#   "default": severity of rules not matched by any entry
+#   "rules": severities by exact rule id
+#   "patterns": [{"glob" | "regex", "severity"}] matched against rule ids, the first match wins
+#   "paths": [{"glob" | "regex", "severity"}] matched against relative paths, override rule severities
+#   "no_line": rule id globs whose annotations are attached to a file rather than a line
+DEFAULT_SEVERITY_CONFIG = {
+    "default": "HIGH",
+    "rules": {
+        "file_length": "LOW",
+        "todo_jira": "MEDIUM",
+    },
+    "patterns": [],
+    "paths": [],
+    "no_line": ["file_length"],
 }
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -37,7 +115,12 @@ def get_args():
     )
 
     parser.add_argument(
-        "--report-path", type=Path, dest="report_path", help="Path to swiftlint report"
+        "--report-path",
+        type=Path,
+        nargs="+",
+        dest="report_paths",
+        help="Paths or glob patterns of swiftlint reports. Several reports, e.g. of separately linted modules, "
+        "are merged by file and line, violations repeated by overlapping module roots are reported once",
     )
 
     parser.add_argument(
@@ -54,86 +137,876 @@ def get_args():
         help="Path to processed result",
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        dest="stream",
+        help="Parse swiftlint report element by element to keep memory usage constant",
+    )
+
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        dest="baseline_path",
+        help="Path to a previous swiftlint report or processed annotations. Only new violations are reported",
+    )
+
+    parser.add_argument(
+        "--severity-config",
+        type=Path,
+        dest="severity_config_path",
+        help="Path to a JSON or YAML severity config, see DEFAULT_SEVERITY_CONFIG for its format",
+    )
 
+    parser.add_argument(
+        "--changed-files",
+        type=Path,
+        dest="changed_files_path",
+        help="Path to a list of changed files (git diff --name-only) or a unified diff relative to the root. "
+        "Only violations in changed files or, for a diff, on changed lines are reported",
+    )
 
-def get_severity(rule_id: str):
-    return RULE_SEVERITY_MAP.get(rule_id, Severity.HIGH)
+    parser.add_argument(
+        "--diff-base",
+        dest="diff_base",
+        help="Git revision to diff the root against, the same as --changed-files with the output of git diff",
+    )
 
+    parser.add_argument(
+        "--shards-dir",
+        type=Path,
+        dest="shards_dir",
+        help="Path to a directory for insight reports split by the Bitbucket annotations limit. "
+        "Replaces --report-output-path and --annotations-output-path",
+    )
 
-def get_line(rule_id: str, line: int):
-    if rule_id == "file_length":
-        return None
+    parser.add_argument(
+        "--insight-key",
+        dest="insight_key",
+        help="Insight key of the first shard, the next ones get a numeric suffix",
+    )
 
-    return line
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        dest="cache_dir",
+        help="Path to a directory with processed reports cached by their inputs. Not used with --diff-base",
+    )
 
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        dest="cache_max_size",
+        default=DEFAULT_CACHE_MAX_SIZE_MB,
+        help="Size cap of the cache directory in megabytes",
+    )
 
-def save_compact_json(path_: Path, data: "dict") -> None:
-    with open(path_, mode="w", encoding=DEFAULT_ENCODING) as f:
-        f.write(json.dumps(data, separators=(",", ":")))
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        dest="jobs",
+        default=1,
+        help="Number of processes converting violations in chunks, 0 means the number of CPUs. "
+        "The result is the same as of a single process",
+    )
+
+    add_output_args(parser)
+    add_upload_args(parser)
+    add_metrics_args(parser)
+
+    return parser.parse_args(argv)
+
+
+def compile_pattern(pattern: dict):
+    """Returns the regex of a {"glob": ...} or {"regex": ...} entry matching a whole string and its compiled form."""
+    if "glob" in pattern:
+        expression = fnmatch.translate(pattern["glob"])
+    elif "regex" in pattern:
+        expression = pattern["regex"]
+        flags = GLOBAL_FLAGS_REGEX.match(expression)
+        if flags:
+            scoped_flags = "".join(re.findall(r"[aiLmsux]", flags.group()))
+            expression = f"(?{scoped_flags}:{expression[flags.end():]})\\Z"
+        else:
+            expression = f"(?:{expression})\\Z"
+    else:
+        raise ValueError(f"Severity config pattern has neither glob nor regex: {pattern}")
+
+    try:
+        if "regex" in pattern:
+            # Positions in errors of the entry as it is written
+            re.compile(pattern["regex"])
+        return expression, re.compile(expression)
+    except re.error as e:
+        raise ValueError(f"Invalid severity config pattern {pattern}: {e}") from None
+
+
+class Patterns:
+    """
+    Entries compiled into a single regex matching a whole string. Every entry becomes a named group,
+    so the first matching entry is found by one match call. Regexes with own groups are matched one by one,
+    as the wrapping groups would shift their numbered backreferences and their names may repeat.
+    """
+
+    def __init__(self, patterns: list):
+        groups = []
+        self.separate = []
+        for index, pattern in enumerate(patterns):
+            expression, regex = compile_pattern(pattern)
+            if "regex" in pattern and regex.groups:
+                self.separate.append((index, regex))
+            else:
+                groups.append(f"(?P<p{index}>{expression})")
+
+        self.combined = re.compile("|".join(groups)) if groups else None
+
+    def match(self, value: str):
+        """Returns the index of the first entry matching the value or None."""
+        index = None
+        if self.combined is not None:
+            match = self.combined.match(value)
+            if match:
+                # The outer group of an entry closes last, so lastgroup is the entry even if it has own groups
+                index = int(match.lastgroup[1:])
+
+        for separate_index, regex in self.separate:
+            if index is not None and separate_index > index:
+                break
+            if regex.match(value):
+                return separate_index
+
+        return index
+
+
+def parse_severity(value: str) -> Severity:
+    try:
+        return Severity(value.upper())
+    except ValueError:
+        raise ValueError(f"Unknown severity '{value}', expected one of: {', '.join(s.value for s in Severity)}")
+
+
+class SeverityRules:
+    """
+    Severity table compiled from a severity config. Precedence: path override, exact rule id,
+    first matching rule pattern, default. Results are cached per rule id and per path.
+    """
+
+    def __init__(self, config: dict):
+        self.default = parse_severity(config.get("default", Severity.HIGH.value))
+        self.rules = {rule_id: parse_severity(value) for rule_id, value in config.get("rules", {}).items()}
+
+        patterns = config.get("patterns", [])
+        self.patterns = Patterns(patterns)
+        self.patterns_severities = [parse_severity(pattern["severity"]) for pattern in patterns]
+
+        paths = config.get("paths", [])
+        self.paths = Patterns(paths)
+        self.paths_severities = [parse_severity(path_["severity"]) for path_ in paths]
+
+        self.no_line = Patterns([{"glob": rule} for rule in config.get("no_line", [])])
+
+        self.rule_cache = {}
+        self.get_path_severity = lru_cache(maxsize=PATH_CACHE_SIZE)(self.match_path)
+
+    def match_rule(self, rule_id: str):
+        severity = self.rules.get(rule_id)
+        if severity is None:
+            index = self.patterns.match(rule_id)
+            severity = self.default if index is None else self.patterns_severities[index]
+
+        return severity, self.no_line.match(rule_id) is None
+
+    def match_path(self, path_: str):
+        index = self.paths.match(path_)
+        return None if index is None else self.paths_severities[index]
+
+    def get_severity(self, rule_id: str, path_: str) -> Severity:
+        path_severity = self.get_path_severity(path_)
+        if path_severity is not None:
+            return path_severity
+
+        return self.get_rule(rule_id)[0]
+
+    def get_line(self, rule_id: str, line: int):
+        return line if self.get_rule(rule_id)[1] else None
+
+    def get_rule(self, rule_id: str):
+        """Returns the severity of a rule and whether its violations keep the line number."""
+        rule = self.rule_cache.get(rule_id)
+        if rule is None:
+            rule = self.rule_cache[rule_id] = self.match_rule(rule_id)
+        return rule
+
+
+def load_severity_config(config_path: Path = None) -> dict:
+    if not config_path:
+        return DEFAULT_SEVERITY_CONFIG
+
+    if not config_path.exists():
+        raise ValueError(f"Severity config does not exist: {config_path}")
+
+    if config_path.suffix in (".yml", ".yaml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("PyYAML is required to read a YAML severity config")
+
+        with open(config_path, mode="r", encoding=DEFAULT_ENCODING) as f:
+            return yaml.safe_load(f) or {}
+
+    with open(config_path, mode="r", encoding=DEFAULT_ENCODING) as f:
+        return json.load(f)
+
+
+def iter_json_array(path_: Path):
+    """Yields elements of the top-level JSON array without loading the whole file."""
+    decoder = json.JSONDecoder()
+
+    with open(path_, mode="r", encoding=DEFAULT_ENCODING) as f:
+        buffer = ""
+        pos = 0
+        eof = False
+        state = "start"
+
+        def read_more():
+            nonlocal buffer, pos, eof
+            chunk = f.read(READ_CHUNK_SIZE)
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            eof = not chunk
+
+        while True:
+            pos = WHITESPACE_REGEX.match(buffer, pos).end()
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"Unexpected end of swiftlint report: {path_}")
+                read_more()
+                continue
+
+            char = buffer[pos]
+            if state == "start":
+                if char != "[":
+                    raise ValueError(f"Swiftlint report is not a JSON array: {path_}")
+                pos += 1
+                state = "first"
+                continue
+
+            if char == "]" and state in ("first", "separator"):
+                return
+
+            if state == "separator":
+                if char != ",":
+                    raise ValueError(f"Unexpected character '{char}' in swiftlint report: {path_}")
+                pos += 1
+                state = "value"
+                continue
+
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                read_more()
+                continue
+
+            # A value at the very end of the buffer may be truncated (e.g. a number)
+            if end == len(buffer) and not eof:
+                read_more()
+                continue
+
+            pos = end
+            state = "separator"
+            yield obj
+
+
+def get_path_resolver(root_path: Path):
+    """Returns a cached function mapping a swiftlint file path to its path relative to the root and its basename."""
+    root_path = os.path.abspath(root_path)
+
+    @lru_cache(maxsize=PATH_CACHE_SIZE)
+    def resolve_path(file_path: str):
+        return os.path.relpath(file_path, root_path), os.path.basename(os.path.normpath(file_path))
+
+    return resolve_path
+
+
+class ChangedLines:
+    """Index of changed files and, for diffs, of sorted non-overlapping changed line ranges of each file."""
+
+    def __init__(self):
+        # None instead of ranges means that the whole file is changed
+        self.files = {}
+
+    def add_file(self, path_: str):
+        self.files[os.path.normpath(path_)] = None
+
+    def add_range(self, path_: str, start: int, end: int):
+        ranges = self.files.setdefault(os.path.normpath(path_), [])
+        if ranges is not None:
+            ranges.append((start, end))
+
+    def add_removal(self, path_: str):
+        self.files.setdefault(os.path.normpath(path_), [])
+
+    def build(self):
+        """Merges the ranges of every file into a pair of sorted starts and ends."""
+        for path_, ranges in self.files.items():
+            if ranges is None:
+                continue
+
+            starts = []
+            ends = []
+            for start, end in sorted(ranges):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.files[path_] = (starts, ends)
+
+        return self
+
+    def contains(self, path_: str, line) -> bool:
+        if path_ not in self.files:
+            return False
+
+        ranges = self.files[path_]
+        if ranges is None or line is None:
+            return True
+
+        starts, ends = ranges
+        index = bisect.bisect_right(starts, line) - 1
+        return index >= 0 and line <= ends[index]
+
+
+def unescape_git_path(match) -> bytes:
+    escape = match.group(1)
+    if len(escape) == 3:
+        return bytes([int(escape, 8)])
+    return GIT_PATH_ESCAPES.get(escape, escape)
+
+
+def unquote_git_path(path_: str) -> str:
+    """
+    Unquotes a path which git quoted because of special characters, e.g. "b/Sub Dir/\\303\\244.swift".
+    Other paths are returned as is.
+    """
+    if len(path_) < 2 or not path_.startswith('"') or not path_.endswith('"'):
+        return path_
+
+    data = GIT_PATH_ESCAPE_REGEX.sub(unescape_git_path, path_[1:-1].encode(DEFAULT_ENCODING))
+    return data.decode(DEFAULT_ENCODING, errors="replace")
+
+
+def parse_changes(lines) -> ChangedLines:
+    """Builds changed lines from a unified diff or, if there are no diff headers, from a list of files."""
+    changes = ChangedLines()
+    path_ = None
+    is_diff = False
+    # Lines of the current hunk left to skip, so that content like "--- x" is not taken for a header
+    old_left = 0
+    new_left = 0
+
+    for line in lines:
+        line = line.rstrip("\n")
+        if old_left or new_left:
+            if line.startswith("-"):
+                old_left -= 1
+            elif line.startswith("+"):
+                new_left -= 1
+            elif not line.startswith("\\"):
+                old_left -= 1
+                new_left -= 1
+        elif line.startswith("diff --git ") or line.startswith("--- "):
+            is_diff = True
+            path_ = None
+        elif line.startswith("+++ "):
+            is_diff = True
+            # A quoted path has no tabs, they are escaped
+            new_path = unquote_git_path(line[4:].split("\t")[0])
+            # Deleted files have no violations
+            path_ = None if new_path == "/dev/null" else new_path.removeprefix("b/")
+        elif line.startswith("@@"):
+            match = HUNK_HEADER_REGEX.match(line)
+            if not match:
+                continue
+
+            old_left = 1 if match.group(1) is None else int(match.group(1))
+            start = int(match.group(2))
+            new_left = 1 if match.group(3) is None else int(match.group(3))
+            if not path_:
+                continue
+
+            if new_left:
+                changes.add_range(path_, start, start + new_left - 1)
+            else:
+                # Only removed lines, the file is still changed
+                changes.add_removal(path_)
+        elif not is_diff and line.strip():
+            changes.add_file(unquote_git_path(line.strip()))
+
+    return changes.build()
+
+
+def load_changes(root_path: Path, changed_files_path: Path = None, diff_base: str = None) -> ChangedLines:
+    if changed_files_path:
+        with open(changed_files_path, mode="r", encoding=DEFAULT_ENCODING) as f:
+            return parse_changes(f)
+
+    output = subprocess.run(
+        ["git", "-c", "core.quotePath=false", "diff", "--relative", "--unified=0", "--no-color", "--no-ext-diff", diff_base],
+        cwd=root_path,
+        check=True,
+        capture_output=True,
+        text=True,
+        encoding=DEFAULT_ENCODING,
+    ).stdout
+    return parse_changes(output.splitlines())
+
+
+def get_fingerprint(path: str, message: str):
+    """Returns a line-insensitive violation fingerprint. The rule is identified by its name in the message."""
+    reason = SPACES_REGEX.sub(" ", DIGITS_REGEX.sub("#", message)).strip()
+    return path, reason
+
+
+def load_baseline(baseline_path: Path, root_path: Path) -> Counter:
+    """Counts fingerprints of violations from a raw swiftlint report or from processed annotations."""
+    with open(baseline_path, mode="r", encoding=DEFAULT_ENCODING) as f:
+        is_swiftlint_report = f.read(READ_CHUNK_SIZE).lstrip().startswith("[")
+
+    baseline = Counter()
+    if is_swiftlint_report:
+        resolve_path = get_path_resolver(root_path)
+        for obj in iter_json_array(baseline_path):
+            relative_path, _ = resolve_path(obj["file"])
+            baseline[get_fingerprint(relative_path, f"{obj['type']}. {obj['reason']}")] += 1
+    else:
+        for annotation in load_json(baseline_path)["annotations"]:
+            baseline[get_fingerprint(annotation["path"], annotation["message"])] += 1
+
+    return baseline
+
+
+def expand_report_paths(report_paths: list) -> list:
+    """Expands glob patterns, every path or pattern must match at least one report."""
+    expanded = []
+    for report_path in report_paths or []:
+        matches = sorted(glob.glob(str(report_path))) if glob.has_magic(str(report_path)) else [report_path]
+        matches = [Path(match) for match in matches if Path(match).exists()]
+        if not matches:
+            raise ValueError(f"Swiftlint report does not exist: {report_path}")
+        expanded.extend(matches)
+
+    return expanded
+
+
+def get_violation_key(obj: dict):
+    return obj["file"], -1 if obj["line"] is None else obj["line"]
+
+
+def check_sorted(objs, report_path: Path):
+    """Yields violations of a streamed report checking that they are sorted by file and line, as merging requires."""
+    previous_key = None
+    for obj in objs:
+        key = get_violation_key(obj)
+        if previous_key is not None and key < previous_key:
+            raise ValueError(
+                f"Swiftlint report is not sorted by file and line, it can be merged only without --stream: {report_path}"
+            )
+        previous_key = key
+        yield obj
+
+
+def decorate_violations(index: int, objs):
+    # The sequence number stops comparison before violations, which are not comparable
+    for sequence, obj in enumerate(objs):
+        yield get_violation_key(obj), index, sequence, obj
+
+
+class MergedReports:
+    """
+    K-way merge of violations of several reports sorted by file and line. A violation equal to one of another report
+    on the same file and line is dropped, such duplicates come from overlapping module roots.
+    """
+
+    def __init__(self, reports: list):
+        self.reports = reports
+        self.duplicates_count = 0
+
+    def __iter__(self):
+        group_key = None
+        group = []
+        decorated = [decorate_violations(index, objs) for index, objs in enumerate(self.reports)]
+        for key, index, _, obj in heapq.merge(*decorated):
+            if key != group_key:
+                group_key = key
+                group = []
+            elif any(other_index != index and other == obj for other_index, other in group):
+                self.duplicates_count += 1
+                continue
+
+            group.append((index, obj))
+            yield obj
+
+
+class ViolationConverter:
+    """
+    Converts swiftlint violations one by one into (fingerprint, serialized annotation, warning, record) tuples.
+    Fingerprints are computed only for baseline matching. The annotation is None for a violation outside of changes,
+    the warning is set for a violation with HIGH severity. The record is the (annotation, rule id) pair for
+    writers of --output, it is returned only if they are used. The conversion doesn't depend on other violations,
+    so it is the part of processing done by the workers of --jobs.
+    """
+
+    def __init__(
+        self,
+        root_path: Path,
+        severity_config: dict,
+        changes: ChangedLines = None,
+        with_fingerprints=False,
+        with_records=False,
+    ):
+        self.severity_rules = SeverityRules(severity_config)
+        self.resolve_path = get_path_resolver(root_path)
+        self.changes = changes
+        self.with_fingerprints = with_fingerprints
+        self.with_records = with_records
+
+    def convert(self, obj: dict):
+        rule_id = obj["rule_id"]
+        relative_path, file_name = self.resolve_path(obj["file"])
+        severity = self.severity_rules.get_severity(rule_id, relative_path)
+        annotation = {
+            "line": self.severity_rules.get_line(rule_id, obj["line"]),
+            "message": f"{obj['type']}. {obj['reason']}",
+            "severity": severity.value,
+            "path": relative_path,
+            "type": "CODE_SMELL",
+        }
+
+        fingerprint = None
+        if self.with_fingerprints:
+            fingerprint = get_fingerprint(annotation["path"], annotation["message"])
+
+        if self.changes is not None and not self.changes.contains(relative_path, annotation["line"]):
+            return fingerprint, None, None, None
+
+        warning = None
+        if severity == Severity.HIGH:
+            warning = f"Critical rule id: {rule_id}. File: {file_name}:{obj['line']}"
+
+        record = (annotation, rule_id) if self.with_records else None
+        return fingerprint, dumps_compact(annotation), warning, record
+
+    def convert_chunk(self, objs) -> tuple:
+        """Converts violations into lists of the tuple items, they are pickled faster than tuples."""
+        return tuple(map(list, zip(*map(self.convert, objs))))
+
+
+# Converter of a worker process of --jobs, created by init_worker
+worker_converter = None
+
+# Violations of the parsed report, forked workers inherit them and get only ranges of their chunks
+worker_objs = None
+
+
+def init_worker(*converter_args) -> None:
+    global worker_converter
+    worker_converter = ViolationConverter(*converter_args)
+
+
+def convert_chunk(objs: list) -> tuple:
+    return worker_converter.convert_chunk(objs)
+
+
+def convert_range(start: int, end: int) -> tuple:
+    return worker_converter.convert_chunk(worker_objs[start:end])
+
+
+def iter_tasks(objs, mp_context):
+    """Yields (function, args) converting the violations chunk by chunk."""
+    if isinstance(objs, list) and mp_context and mp_context.get_start_method() == "fork":
+        for start in range(0, len(objs), JOB_CHUNK_SIZE):
+            yield convert_range, (start, start + JOB_CHUNK_SIZE)
+        return
+
+    objs = iter(objs)
+    while chunk := list(islice(objs, JOB_CHUNK_SIZE)):
+        yield convert_chunk, (chunk,)
+
+
+def convert_in_workers(objs, jobs: int, converter_args: tuple, metrics: Metrics):
+    """
+    Yields converted violations in the report order, chunks of them are converted by a process pool.
+    Only a few chunks are submitted ahead of the one being consumed, so the streaming mode keeps memory bounded.
+    """
+    global worker_objs
+    mp_context = get_mp_context()
+    worker_objs = objs if isinstance(objs, list) else None
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=jobs, mp_context=mp_context, initializer=init_worker, initargs=converter_args
+        ) as executor:
+            pending = deque()
+            for function, args in iter_tasks(objs, mp_context):
+                pending.append(executor.submit(function, *args))
+                metrics.count("chunks")
+                if len(pending) > jobs * JOB_CHUNKS_AHEAD:
+                    yield from zip(*pending.popleft().result())
+
+            while pending:
+                yield from zip(*pending.popleft().result())
+    finally:
+        worker_objs = None
 
 
 def process_report(
-    report_path: Path,
+    report_paths: list,
     root_path: Path,
     report_output_path: Path,
     annotations_output_path: Path,
+    *,
+    stream: bool = False,
+    baseline_path: Path = None,
+    shards_dir: Path = None,
+    insight_key: str = None,
+    severity_config_path: Path = None,
+    changed_files_path: Path = None,
+    diff_base: str = None,
+    cache_dir: Path = None,
+    cache_max_size: int = DEFAULT_CACHE_MAX_SIZE_MB,
+    metrics: Metrics = None,
+    jobs: int = 1,
+    outputs: list = (),
+    uploader: InsightsUploader = None,
 ):
-    if not report_path or not report_path.exists():
+    metrics = metrics or Metrics("linter")
+
+    report_paths = expand_report_paths(report_paths)
+    if not report_paths:
         raise ValueError("Path to swiftlint report is not given")
 
     if not root_path or not root_path.exists():
         raise ValueError("Path to repo root is not given")
 
-    if not report_output_path:
-        raise ValueError("Insight report output path is not given")
-
-    if not annotations_output_path:
-        raise ValueError("Annotations output path is not given")
+    if shards_dir:
+        if not insight_key:
+            raise ValueError("Insight key is not given")
+    else:
+        if not report_output_path:
+            raise ValueError("Insight report output path is not given")
+
+        if not annotations_output_path:
+            raise ValueError("Annotations output path is not given")
+
+    if baseline_path and not baseline_path.exists():
+        raise ValueError(f"Baseline does not exist: {baseline_path}")
+
+    if changed_files_path and not changed_files_path.exists():
+        raise ValueError(f"Changed files list does not exist: {changed_files_path}")
+
+    output_writers = OutputWriters(outputs, "swiftlint")
+
+    cache = None
+    if cache_dir and diff_base:
+        # Changes depend on the state of the repository rather than on input files
+        logging.info("Processed reports cache is not used with a diff base")
+    elif cache_dir:
+        cache = ReportCache(cache_dir, cache_max_size)
+        cache_key = cache.get_key(
+            Path(__file__),
+            len(report_paths),
+            *report_paths,
+            os.path.abspath(root_path),
+            baseline_path,
+            severity_config_path,
+            changed_files_path,
+            shards_dir and insight_key,
+            *output_writers.get_cache_key_parts(),
+        )
+        is_restored = restore_cached(
+            cache,
+            cache_key,
+            shards_dir,
+            report_output_path,
+            annotations_output_path,
+            output_writers.get_cache_outputs(),
+            metrics,
+        )
+        if is_restored:
+            if uploader:
+                uploader.upload(
+                    load_uploads(insight_key, shards_dir, report_output_path, annotations_output_path), metrics
+                )
+            return
+
+    changes = None
+    skipped_count = 0
+    baseline = None
+    new_count = 0
+    existing_count = 0
+    with metrics.phase("load"):
+        if changed_files_path or diff_base:
+            changes = load_changes(root_path, changed_files_path, diff_base)
+            logging.info(f"Only violations in {len(changes.files)} changed files are reported")
+
+        severity_config = load_severity_config(severity_config_path)
+
+        if baseline_path:
+            baseline = load_baseline(baseline_path, root_path)
+            logging.info(f"Loaded baseline with {sum(baseline.values())} violations: {baseline_path}")
+
+        # The streamed report is parsed during the transform phase
+        if stream:
+            reports = [iter_json_array(report_path) for report_path in report_paths]
+        else:
+            reports = [load_json(report_path) for report_path in report_paths]
+
+        merged = None
+        if len(reports) == 1:
+            annotations_json = reports[0]
+        else:
+            logging.info(f"Merging {len(reports)} swiftlint reports")
+            if stream:
+                reports = [check_sorted(objs, report_path) for objs, report_path in zip(reports, report_paths)]
+            else:
+                for objs in reports:
+                    objs.sort(key=get_violation_key)
+
+            merged = MergedReports(reports)
+            # A list lets forked workers of --jobs get only ranges of chunks
+            annotations_json = merged if stream else list(merged)
 
-    annotations = []
     is_passed = True
 
-    annotations_json = json.loads(report_path.read_text())
-
-    logging.info(f"Start process swiftlint report: {report_path}")
-    for json_obj in annotations_json:
-        obj = SimpleNamespace(**json_obj)
-        severity = get_severity(obj.rule_id)
-        if severity == Severity.HIGH:
-            logging.warning(f"Critical rule id: {obj.rule_id}. File: {os.path.basename(os.path.normpath(obj.file))}:{obj.line}")
-
-        if is_passed:
-            is_passed = severity != Severity.HIGH
-
-        annotations.append(
-            {
-                "line": get_line(obj.rule_id, obj.line),
-                "message": f"{obj.type}. {obj.reason}",
-                "severity": severity.value,
-                "path": os.path.relpath(obj.file, root_path),
-                "type": "CODE_SMELL",
-            }
-        )
+    logging.info(f"Start process swiftlint report: {', '.join(map(str, report_paths))}")
+    if shards_dir:
+        annotations = ShardedAnnotationsWriter(shards_dir, insight_key, keep_body=uploader is not None)
+    else:
+        annotations = AnnotationsWriter(annotations_output_path, keep_body=uploader is not None)
+
+    # The converter of the parent validates the severity config even if workers convert violations
+    converter_args = (root_path, severity_config, changes, baseline is not None, bool(output_writers))
+    converter = ViolationConverter(*converter_args)
+
+    jobs = max(jobs or os.cpu_count() or 1, 1)
+    if jobs > 1:
+        logging.info(f"Converting violations in {jobs} processes")
+        converted = convert_in_workers(annotations_json, jobs, converter_args, metrics)
+    else:
+        converted = map(converter.convert, annotations_json)
+
+    # Baseline matching depends on the order of violations, so it is done here rather than by the converter
+    violations_count = 0
+    critical_count = 0
+    with metrics.phase("transform"), annotations, output_writers:
+        for fingerprint, annotation, warning, record in converted:
+            violations_count += 1
+
+            if baseline is not None:
+                if baseline[fingerprint] > 0:
+                    baseline[fingerprint] -= 1
+                    existing_count += 1
+                    continue
+
+            if annotation is None:
+                skipped_count += 1
+                continue
+
+            if baseline is not None:
+                new_count += 1
+
+            if warning:
+                critical_count += 1
+                if critical_count <= MAX_LOGGED_CRITICAL_VIOLATIONS:
+                    logging.warning(warning)
+                is_passed = False
+
+            annotations.write_encoded(annotation)
+            if record:
+                output_writers.write(*record)
     logging.info(f"End swiftlint report processing")
 
+    if critical_count > MAX_LOGGED_CRITICAL_VIOLATIONS:
+        logging.warning(f"Critical violations not logged: {critical_count - MAX_LOGGED_CRITICAL_VIOLATIONS}")
+
+    metrics.count("violations", violations_count)
+    metrics.count("critical_violations", critical_count)
+    if merged:
+        logging.info(f"Dropped violations repeated in several reports: {merged.duplicates_count}")
+        metrics.count("reports", len(reports))
+        metrics.count("duplicate_violations", merged.duplicates_count)
+    metrics.count("annotations", annotations.count)
+    metrics.count("existing_violations", existing_count)
+    metrics.count("skipped_violations", skipped_count)
+    # With workers, paths are resolved by their converters
+    if jobs == 1:
+        metrics.count("unique_paths", converter.resolve_path.cache_info().currsize)
+
     insight_report = {
         "title": "Codestyle report",
         "reporter": "swiftlint",
         "result": "PASS" if is_passed else "FAIL",
     }
 
-    save_compact_json(report_output_path, insight_report)
+    if baseline is not None:
+        fixed_count = sum(baseline.values())
+        logging.info(f"New violations: {new_count}. Existing: {existing_count}. Fixed: {fixed_count}")
 
-    save_compact_json(annotations_output_path, {"annotations": annotations})
+        insight_report["details"] = (
+            f"New violations: {new_count}. Existing violations: {existing_count}. Fixed violations: {fixed_count}."
+        )
+        insight_report["data"] = [
+            {"title": "New violations", "type": "NUMBER", "value": new_count},
+            {"title": "Existing violations", "type": "NUMBER", "value": existing_count},
+            {"title": "Fixed violations", "type": "NUMBER", "value": fixed_count},
+        ]
+
+    if changes is not None:
+        logging.info(f"Skipped violations outside of changes: {skipped_count}")
+
+        changes_details = "Only violations in changed lines are reported."
+        if "details" in insight_report:
+            changes_details = f"{insight_report['details']} {changes_details}"
+        insight_report["details"] = changes_details
+
+    with metrics.phase("write"):
+        output_paths = write_insight_reports(annotations, insight_report, report_output_path)
+    metrics.count_bytes(output_paths + [output_path for _, output_path in outputs])
+
+    if cache:
+        store_cached(cache, cache_key, annotations, report_output_path, output_writers.get_cache_outputs(), metrics)
+
+    if uploader:
+        uploader.upload(build_uploads(annotations, insight_report, insight_key), metrics)
+
+
+def main(argv=None):
+    args = get_args(argv)
+
+    with Metrics("linter", args.metrics_path, args.profile_path, args.trace_memory) as metrics:
+        process_report(
+            args.report_paths,
+            args.root_path,
+            args.report_output_path,
+            args.annotations_output_path,
+            stream=args.stream,
+            baseline_path=args.baseline_path,
+            shards_dir=args.shards_dir,
+            insight_key=args.insight_key,
+            severity_config_path=args.severity_config_path,
+            changed_files_path=args.changed_files_path,
+            diff_base=args.diff_base,
+            cache_dir=args.cache_dir,
+            cache_max_size=args.cache_max_size,
+            metrics=metrics,
+            jobs=args.jobs,
+            outputs=args.outputs,
+            uploader=get_uploader(args),
+        )
 
 
 if __name__ == "__main__":
-    args = get_args()
-
-    process_report(
-        args.report_path,
-        args.root_path,
-        args.report_output_path,
-        args.annotations_output_path,
-    )
+    main()
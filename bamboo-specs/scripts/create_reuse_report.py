@@ -3,16 +3,27 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import argparse
-import json
+import heapq
 import logging
-import os
+from collections import Counter
 from enum import Enum
 from pathlib import Path
 
-DEFAULT_ENCODING = "UTF-8"
-
-# Bitbucket API limitation: max 1,000 annotations per report
-MAX_ANNOTATIONS = 1000
+from report_common import (
+    DEFAULT_CACHE_MAX_SIZE_MB,
+    MAX_ANNOTATIONS,
+    AnnotationsWriter,
+    Metrics,
+    ReportCache,
+    ShardedAnnotationsWriter,
+    add_metrics_args,
+    load_json,
+    restore_cached,
+    store_cached,
+    write_insight_reports,
+)
+from report_uploader import InsightsUploader, add_upload_args, build_uploads, get_uploader, load_uploads
+from report_writers import OutputWriters, add_output_args
 
 
 class Severity(str, Enum):
@@ -21,7 +32,69 @@ class Severity(str, Enum):
     HIGH = "HIGH"
 
 
-def get_args():
+SEVERITY_RANKS = {
+    Severity.LOW: 0,
+    Severity.MEDIUM: 1,
+    Severity.HIGH: 2,
+}
+
+
+class CategoryKind(str, Enum):
+    # {license_id: [file_path, ...]}
+    LICENSE_FILES = "license_files"
+    # [file_path, ...]
+    FILES = "files"
+    # [license_id, ...], reuse doesn't map these licenses to files, they are reported on LICENSES_PATH
+    LICENSES = "licenses"
+
+
+LICENSES_PATH = "LICENSES/"
+
+# Non-compliant categories of a reuse lint report, messages of a file are joined in this order.
+# Weight ranks annotations of the same severity, the more actionable a category, the higher its weight.
+# A category with HIGH severity fails the report.
+CATEGORIES = {
+    "bad_licenses": {
+        "kind": CategoryKind.LICENSE_FILES,
+        "severity": Severity.HIGH,
+        "weight": 6,
+        "message": "Bad license identifier: '{license_id}' is not a valid SPDX identifier",
+    },
+    "missing_licenses": {
+        "kind": CategoryKind.LICENSE_FILES,
+        "severity": Severity.HIGH,
+        "weight": 3,
+        "message": "Missing license file: License '{license_id}' not found in LICENSES/ directory",
+    },
+    "missing_licensing_info": {
+        "kind": CategoryKind.FILES,
+        "severity": Severity.HIGH,
+        "weight": 5,
+        "message": "Missing SPDX-License-Identifier tag",
+    },
+    # In reuse 5.x this is called "missing_copyright_info"
+    "missing_copyright_info": {
+        "kind": CategoryKind.FILES,
+        "severity": Severity.HIGH,
+        "weight": 4,
+        "message": "Missing SPDX-FileCopyrightText tag",
+    },
+    "read_errors": {
+        "kind": CategoryKind.FILES,
+        "severity": Severity.HIGH,
+        "weight": 2,
+        "message": "Cannot read file - check permissions",
+    },
+    "deprecated_licenses": {
+        "kind": CategoryKind.LICENSES,
+        "severity": Severity.LOW,
+        "weight": 1,
+        "message": "Deprecated SPDX license identifier: '{license_id}'. Consider updating to a current identifier",
+    },
+}
+
+
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -42,32 +115,164 @@ def get_args():
         help="Path to processed result",
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--shards-dir",
+        type=Path,
+        dest="shards_dir",
+        help="Path to a directory for insight reports split by the Bitbucket annotations limit. "
+        "Replaces --report-output-path and --annotations-output-path",
+    )
 
+    parser.add_argument(
+        "--insight-key",
+        dest="insight_key",
+        help="Insight key of the first shard, the next ones get a numeric suffix",
+    )
 
-def save_compact_json(path_: Path, data: dict) -> None:
-    with open(path_, mode="w", encoding=DEFAULT_ENCODING) as f:
-        f.write(json.dumps(data, separators=(",", ":")))
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        dest="cache_dir",
+        help="Path to a directory with processed reports cached by their inputs",
+    )
+
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        dest="cache_max_size",
+        default=DEFAULT_CACHE_MAX_SIZE_MB,
+        help="Size cap of the cache directory in megabytes",
+    )
+
+    add_output_args(parser)
+    add_upload_args(parser)
+    add_metrics_args(parser)
+
+    return parser.parse_args(argv)
+
+
+def iter_violations(non_compliant: dict):
+    """Yields (category name, path, message) of every violation in the order of CATEGORIES."""
+    for name, category in CATEGORIES.items():
+        entries = non_compliant.get(name) or {}
+        kind = category["kind"]
+
+        if kind == CategoryKind.LICENSE_FILES:
+            for license_id, files in entries.items():
+                message = category["message"].format(license_id=license_id)
+                for file_path in files:
+                    yield name, file_path, message
+        elif kind == CategoryKind.FILES:
+            message = category["message"]
+            for file_path in entries:
+                yield name, file_path, message
+        else:
+            for license_id in entries:
+                yield name, LICENSES_PATH, category["message"].format(license_id=license_id)
+
+
+def get_category_rank(name: str):
+    category = CATEGORIES[name]
+    return SEVERITY_RANKS[category["severity"]], category["weight"]
+
+
+def add_finding(findings: dict, path: str, name: str, message: str) -> None:
+    """Merges a finding into the single annotation kept per path, its category is the most severe one."""
+    category = CATEGORIES[name]
+    severity = category["severity"]
+    finding = findings.get(path)
+    if finding is None:
+        finding = {"severity": severity, "weight": 0, "messages": [], "category": name}
+        findings[path] = finding
+    else:
+        if SEVERITY_RANKS[severity] > SEVERITY_RANKS[finding["severity"]]:
+            finding["severity"] = severity
+        if get_category_rank(name) > get_category_rank(finding["category"]):
+            finding["category"] = name
+
+    finding["weight"] += category["weight"]
+    finding["messages"].append(message)
+
+
+def select_annotations(findings: dict, limit: int = None):
+    """
+    Yields (annotation, category name) for the `limit` most severe findings using a bounded heap, ties keep report
+    order. Without a limit all findings are sorted, their first `limit` ones are the same as the selected ones.
+    """
+    key = lambda item: (SEVERITY_RANKS[item[1]["severity"]], item[1]["weight"])
+    if limit is None:
+        top_findings = sorted(findings.items(), key=key, reverse=True)
+    else:
+        top_findings = heapq.nlargest(limit, findings.items(), key=key)
+
+    for path, finding in top_findings:
+        annotation = {
+            "line": None,
+            "message": "; ".join(finding["messages"]),
+            "severity": finding["severity"].value,
+            "path": path,
+            "type": "VULNERABILITY",
+        }
+        yield annotation, finding["category"]
 
 
 def process_report(
     report_path: Path,
     report_output_path: Path,
     annotations_output_path: Path,
+    *,
+    shards_dir: Path = None,
+    insight_key: str = None,
+    cache_dir: Path = None,
+    cache_max_size: int = DEFAULT_CACHE_MAX_SIZE_MB,
+    metrics: Metrics = None,
+    outputs: list = (),
+    uploader: InsightsUploader = None,
 ):
+    metrics = metrics or Metrics("reuse")
+
     if not report_path or not report_path.exists():
         raise ValueError("Path to reuse lint report is not given")
 
-    if not report_output_path:
-        raise ValueError("Insight report output path is not given")
+    if shards_dir:
+        if not insight_key:
+            raise ValueError("Insight key is not given")
+    else:
+        if not report_output_path:
+            raise ValueError("Insight report output path is not given")
+
+        if not annotations_output_path:
+            raise ValueError("Annotations output path is not given")
 
-    if not annotations_output_path:
-        raise ValueError("Annotations output path is not given")
+    output_writers = OutputWriters(outputs, "reuse")
 
-    annotations = []
+    cache = None
+    if cache_dir:
+        cache = ReportCache(cache_dir, cache_max_size)
+        cache_key = cache.get_key(
+            Path(__file__), report_path, shards_dir and insight_key, *output_writers.get_cache_key_parts()
+        )
+        is_restored = restore_cached(
+            cache,
+            cache_key,
+            shards_dir,
+            report_output_path,
+            annotations_output_path,
+            output_writers.get_cache_outputs(),
+            metrics,
+        )
+        if is_restored:
+            if uploader:
+                uploader.upload(
+                    load_uploads(insight_key, shards_dir, report_output_path, annotations_output_path), metrics
+                )
+            return
+
+    findings = {}
     is_passed = True
 
-    report_json = json.loads(report_path.read_text())
+    with metrics.phase("load"):
+        report_json = load_json(report_path)
 
     logging.info(f"Start processing reuse lint report: {report_path}")
 
@@ -75,135 +280,60 @@ def process_report(
     non_compliant = report_json.get("non_compliant", {})
     summary = report_json.get("summary", {})
 
-    # Process bad licenses (HIGH severity)
-    for license_id, files in (non_compliant.get("bad_licenses", {}) or {}).items():
-        for file_path in files:
-            severity = Severity.HIGH
-            is_passed = False
+    category_counts = Counter()
+    with metrics.phase("transform"):
+        for name, path, message in iter_violations(non_compliant):
+            add_finding(findings, path, name, message)
+            category_counts[name] += 1
 
-            logging.warning(f"Bad license: {license_id}. File: {os.path.basename(file_path)}")
-
-            annotations.append(
-                {
-                    "line": None,
-                    "message": f"Bad license identifier: '{license_id}' is not a valid SPDX identifier",
-                    "severity": severity.value,
-                    "path": file_path,
-                    "type": "VULNERABILITY",
-                }
-            )
-
-    # Process missing licenses (HIGH severity)
-    for license_id, files in (non_compliant.get("missing_licenses", {}) or {}).items():
-        for file_path in files:
-            severity = Severity.HIGH
+    # Per-file logs would cost more than the processing itself, counts are logged instead
+    for name, count in category_counts.items():
+        if CATEGORIES[name]["severity"] == Severity.HIGH:
             is_passed = False
-
-            logging.warning(f"Missing license: {license_id}. File: {os.path.basename(file_path)}")
-
-            annotations.append(
-                {
-                    "line": None,
-                    "message": f"Missing license file: License '{license_id}' not found in LICENSES/ directory",
-                    "severity": severity.value,
-                    "path": file_path,
-                    "type": "VULNERABILITY",
-                }
-            )
-
-    # Process files without licenses (HIGH severity)
-    for file_path in non_compliant.get("missing_licensing_info", []):
-        severity = Severity.HIGH
-        is_passed = False
-
-        logging.warning(f"No license identifier. File: {os.path.basename(file_path)}")
-
-        annotations.append(
-            {
-                "line": None,
-                "message": "Missing SPDX-License-Identifier tag",
-                "severity": severity.value,
-                "path": file_path,
-                "type": "VULNERABILITY",
-            }
-        )
-
-    # Process files without copyright (HIGH severity)
-    # In reuse 5.x this is called "missing_copyright_info"
-    for file_path in non_compliant.get("missing_copyright_info", []):
-        severity = Severity.HIGH
-        is_passed = False
-
-        logging.warning(f"No copyright notice. File: {os.path.basename(file_path)}")
-
-        annotations.append(
-            {
-                "line": None,
-                "message": "Missing SPDX-FileCopyrightText tag",
-                "severity": severity.value,
-                "path": file_path,
-                "type": "VULNERABILITY",
-            }
-        )
-
-    # Process read errors (HIGH severity)
-    for file_path in non_compliant.get("read_errors", []):
-        severity = Severity.HIGH
-        is_passed = False
-
-        logging.error(f"Read error. File: {os.path.basename(file_path)}")
-
-        annotations.append(
-            {
-                "line": None,
-                "message": "Cannot read file - check permissions",
-                "severity": severity.value,
-                "path": file_path,
-                "type": "VULNERABILITY",
-            }
-        )
-
-    # Process deprecated licenses (LOW severity)
-    for license_id in non_compliant.get("deprecated_licenses", []):
-        severity = Severity.LOW
-
-        logging.info(f"Deprecated license: {license_id}")
-
-        # Find files using this deprecated license
-        # Note: reuse doesn't provide file mapping for deprecated licenses
-        # We'll create a single annotation for the project
-        annotations.append(
-            {
-                "line": None,
-                "message": f"Deprecated SPDX license identifier: '{license_id}'. Consider updating to a current identifier",
-                "severity": severity.value,
-                "path": "LICENSES/",
-                "type": "VULNERABILITY",
-            }
-        )
+            logging.warning(f"Non-compliant {name}: {count}")
+        else:
+            logging.info(f"Non-compliant {name}: {count}")
 
     logging.info(f"End reuse lint report processing")
-    logging.info(f"Total annotations: {len(annotations)}")
+
+    total_annotations = sum(len(finding["messages"]) for finding in findings.values())
+    logging.info(f"Total violations: {total_annotations}")
+    logging.info(f"Total annotations: {len(findings)}")
     logging.info(f"Is compliant: {summary.get('compliant', False)}")
 
-    # Apply Bitbucket API annotation limit
-    total_annotations = len(annotations)
+    # Apply Bitbucket API annotation limit, unless annotations are split into several reports
+    limit = MAX_ANNOTATIONS
     truncated = False
-    if total_annotations > MAX_ANNOTATIONS:
+    if shards_dir:
+        limit = len(findings)
+    elif len(findings) > MAX_ANNOTATIONS:
         logging.warning(
-            f"Annotations count ({total_annotations}) exceeds Bitbucket limit ({MAX_ANNOTATIONS}). "
-            f"Truncating to first {MAX_ANNOTATIONS} annotations."
+            f"Annotations count ({len(findings)}) exceeds Bitbucket limit ({MAX_ANNOTATIONS}). "
+            f"Keeping {MAX_ANNOTATIONS} most severe annotations."
         )
-        annotations = annotations[:MAX_ANNOTATIONS]
         truncated = True
-    
-    logging.info(f"Annotations to be sent: {len(annotations)}")
+
+    if shards_dir:
+        annotations = ShardedAnnotationsWriter(shards_dir, insight_key, keep_body=uploader is not None)
+    else:
+        annotations = AnnotationsWriter(annotations_output_path, keep_body=uploader is not None)
+
+    # Selection is lazy, so the sort phase includes writing of the annotations.
+    # Writers of --output get all findings, only the Bitbucket annotations are limited.
+    with metrics.phase("sort"), annotations, output_writers:
+        selected = select_annotations(findings, None if output_writers else limit)
+        for index, (annotation, category_name) in enumerate(selected):
+            if index < limit:
+                annotations.write(annotation)
+            output_writers.write(annotation, category_name)
+
+    logging.info(f"Annotations to be sent: {annotations.count}")
 
     # Build report details with truncation info
     report_details = f"Total violations found: {total_annotations}"
     if truncated:
-        report_details += f". Showing first {MAX_ANNOTATIONS} annotations due to Bitbucket API limit."
-    
+        report_details += f". Showing {MAX_ANNOTATIONS} most severe annotations due to Bitbucket API limit."
+
     # Build detailed report with statistics
     insight_report = {
         "title": "REUSE Compliance",
@@ -212,15 +342,38 @@ def process_report(
         "details": report_details,
     }
 
-    save_compact_json(report_output_path, insight_report)
-    save_compact_json(annotations_output_path, {"annotations": annotations})
+    metrics.count("violations", total_annotations)
+    metrics.count("findings", len(findings))
+    metrics.count("annotations", annotations.count)
 
+    with metrics.phase("write"):
+        output_paths = write_insight_reports(annotations, insight_report, report_output_path)
+    metrics.count_bytes(output_paths + [output_path for _, output_path in outputs])
 
-if __name__ == "__main__":
-    args = get_args()
+    if cache:
+        store_cached(cache, cache_key, annotations, report_output_path, output_writers.get_cache_outputs(), metrics)
 
-    process_report(
-        args.report_path,
-        args.report_output_path,
-        args.annotations_output_path,
-    )
+    if uploader:
+        uploader.upload(build_uploads(annotations, insight_report, insight_key), metrics)
+
+
+def main(argv=None):
+    args = get_args(argv)
+
+    with Metrics("reuse", args.metrics_path, args.profile_path, args.trace_memory) as metrics:
+        process_report(
+            args.report_path,
+            args.report_output_path,
+            args.annotations_output_path,
+            shards_dir=args.shards_dir,
+            insight_key=args.insight_key,
+            cache_dir=args.cache_dir,
+            cache_max_size=args.cache_max_size,
+            metrics=metrics,
+            outputs=args.outputs,
+            uploader=get_uploader(args),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,567 @@
+# SPDX-FileCopyrightText: AdGuard Software Limited
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import cProfile
+import hashlib
+import importlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+DEFAULT_ENCODING = "UTF-8"
+
+# Bitbucket API limitation: max 1,000 annotations per report
+MAX_ANNOTATIONS = 1000
+
+SHARDS_MANIFEST_NAME = "shards.json"
+
+# Size cap of the processed reports cache, least recently used entries are evicted above it
+DEFAULT_CACHE_MAX_SIZE_MB = 512
+
+# JSON backend: "orjson", "ujson" or "json", by default the first installed one is used.
+# ujson only parses, its output escaping differs from the stdlib one
+JSON_BACKEND_ENV = "REPORT_JSON_BACKEND"
+JSON_BACKENDS = ("orjson", "ujson", "json")
+COMPACT_SEPARATORS = (",", ":")
+
+# Float formatting of orjson differs from the stdlib one and between its versions, so output with anything
+# that may be a float goes to the stdlib. Every finite float has a digit followed by a point or an exponent,
+# a string matching this only takes the slower path. orjson also does not escape non-ASCII characters
+FLOAT_REGEX = re.compile(rb"\d[.eE]")
+NON_ASCII_REGEX = re.compile(r"[\x7f-\U0010ffff]")
+
+
+def select_json_backend():
+    """Returns the name of the JSON backend and its module, None for the stdlib one."""
+    requested = os.environ.get(JSON_BACKEND_ENV)
+    if requested and requested not in JSON_BACKENDS:
+        raise ValueError(f"Unknown JSON backend '{requested}', expected one of: {', '.join(JSON_BACKENDS)}")
+
+    for name in (requested,) if requested else JSON_BACKENDS:
+        if name == "json":
+            break
+        try:
+            return name, importlib.import_module(name)
+        except ImportError:
+            if requested:
+                logging.warning(f"JSON backend {name} is not installed, using the json module")
+
+    return "json", None
+
+
+JSON_BACKEND, json_module = select_json_backend()
+
+
+def escape_non_ascii(match) -> str:
+    code = ord(match.group())
+    if code < 0x10000:
+        return f"\\u{code:04x}"
+
+    # Characters outside of the BMP are written as surrogate pairs, the same as json.dumps does
+    code -= 0x10000
+    return f"\\u{0xd800 | (code >> 10):04x}\\u{0xdc00 | (code & 0x3ff):04x}"
+
+
+def dumps_compact(data) -> bytes:
+    """
+    Serializes data to compact ASCII JSON, the result is the same as json.dumps with compact separators.
+    Non-finite floats, which are not valid JSON, are written by orjson as null.
+    """
+    if JSON_BACKEND == "orjson":
+        try:
+            output = json_module.dumps(data)
+        except TypeError:
+            # Integers above 64 bits, lone surrogates or non-string keys
+            output = None
+
+        if output is not None and not FLOAT_REGEX.search(output):
+            if not output.isascii() or b"\x7f" in output:
+                output = NON_ASCII_REGEX.sub(escape_non_ascii, output.decode(DEFAULT_ENCODING)).encode()
+            return output
+
+    return json.dumps(data, separators=COMPACT_SEPARATORS).encode()
+
+
+def loads(data):
+    """
+    Parses JSON from str, bytes or a memoryview, documents the fast backend can't parse go to the stdlib.
+    orjson parses integers above 64 bits as floats, reports have no such numbers.
+    """
+    if json_module is not None:
+        try:
+            return json_module.loads(data)
+        except ValueError:
+            # The stdlib accepts NaN, Infinity and lone surrogates
+            pass
+
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def load_json(path_: Path):
+    """
+    Parses a JSON file. orjson parses the memory mapped file in place, without reading it to bytes and decoding to str.
+    The stdlib parser decodes the file to str, as parsing bytes would keep both of them in memory.
+    """
+    if json_module is None:
+        return json.loads(path_.read_text(encoding=DEFAULT_ENCODING))
+
+    with open(path_, mode="rb") as f:
+        # Empty files can not be memory mapped
+        if JSON_BACKEND != "orjson" or not os.fstat(f.fileno()).st_size:
+            return loads(f.read())
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+            return loads(view)
+
+
+def save_compact_json(path_: Path, data: dict) -> None:
+    with open(path_, mode="wb") as f:
+        f.write(dumps_compact(data))
+
+
+class AnnotationsWriter:
+    """
+    Writes annotations one by one, the result is the same as save_compact_json of the whole list.
+    With `keep_body` the written bytes are also kept in `body`, so they are uploaded without reading the file back.
+    """
+
+    def __init__(self, path_: Path, keep_body=False):
+        self.path = path_
+        self.count = 0
+        self.body = bytearray() if keep_body else None
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, mode="wb")
+        self._write(b'{"annotations":[')
+        return self
+
+    def _write(self, data: bytes) -> None:
+        self._file.write(data)
+        if self.body is not None:
+            self.body += data
+
+    def write(self, annotation: dict) -> None:
+        self.write_encoded(dumps_compact(annotation))
+
+    def write_encoded(self, annotation: bytes) -> None:
+        """Writes an annotation already serialized by dumps_compact."""
+        if self.count:
+            self._write(b",")
+        self._write(annotation)
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._write(b"]}")
+        self._file.close()
+
+
+class ShardedAnnotationsWriter:
+    """
+    Splits annotations into files of at most `shard_size` annotations, each one is sent as a separate insight report.
+
+    The first shard uses the given insight key, the next ones get a numeric suffix.
+    Shards are described in the manifest file, which is written by `write_reports`.
+    """
+
+    def __init__(self, shards_dir: Path, insight_key: str, shard_size: int = MAX_ANNOTATIONS, keep_body=False):
+        self.shards_dir = shards_dir
+        self.insight_key = insight_key
+        self.shard_size = shard_size
+        self.keep_body = keep_body
+        self.count = 0
+        self.files = []
+        # (insight key, encoded report, encoded annotations, annotations count) of every shard with `keep_body`
+        self.uploads = []
+        self._shards = []
+        self._writer = None
+
+    def __enter__(self):
+        self.shards_dir.mkdir(parents=True, exist_ok=True)
+        return self
+
+    def _open_shard(self) -> None:
+        if self._writer:
+            self._close_shard()
+
+        index = len(self._shards) + 1
+        self._writer = AnnotationsWriter(self.shards_dir / f"annotations.{index}.json", self.keep_body).__enter__()
+
+    def _close_shard(self) -> None:
+        self._writer.__exit__(None, None, None)
+        self._shards.append(self._writer)
+        self._writer = None
+
+    def write(self, annotation: dict) -> None:
+        self.write_encoded(dumps_compact(annotation))
+
+    def write_encoded(self, annotation: bytes) -> None:
+        if not self._writer or self._writer.count == self.shard_size:
+            self._open_shard()
+
+        self._writer.write_encoded(annotation)
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Always produce at least one shard, so the base report is sent even without annotations
+        if not self._writer and not self._shards:
+            self._open_shard()
+
+        if self._writer:
+            self._close_shard()
+
+    def get_insight_key(self, index: int) -> str:
+        return self.insight_key if index == 1 else f"{self.insight_key}.{index}"
+
+    def write_reports(self, insight_report: dict) -> None:
+        """Writes an insight report per shard and the manifest."""
+        shards_count = len(self._shards)
+        manifest = []
+
+        for index, shard in enumerate(self._shards, start=1):
+            report = dict(insight_report)
+            if shards_count > 1:
+                report["title"] = f"{insight_report['title']} ({index}/{shards_count})"
+
+            report_name = f"insight_report.{index}.json"
+            save_compact_json(self.shards_dir / report_name, report)
+            self.files += [self.shards_dir / report_name, shard.path]
+            if self.keep_body:
+                self.uploads.append(
+                    (self.get_insight_key(index), dumps_compact(report), bytes(shard.body), shard.count)
+                )
+
+            manifest.append(
+                {
+                    "insight_key": self.get_insight_key(index),
+                    "report": report_name,
+                    "annotations": shard.path.name,
+                    "annotations_count": shard.count,
+                }
+            )
+
+        save_compact_json(self.shards_dir / SHARDS_MANIFEST_NAME, {"shards": manifest})
+        self.files.append(self.shards_dir / SHARDS_MANIFEST_NAME)
+        logging.info(f"Split {self.count} annotations into {shards_count} insight reports: {self.shards_dir}")
+
+
+class ReportCache:
+    """
+    Content-addressed cache of processed reports. An entry is a directory named by the hash of everything
+    that affects the output: input files, scripts and options. Entries are evicted by last use time.
+    """
+
+    def __init__(self, cache_dir: Path, max_size_mb: int = DEFAULT_CACHE_MAX_SIZE_MB):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+
+    @staticmethod
+    def get_key(*parts) -> str:
+        """
+        Hashes key parts: contents of Path parts, which are memory mapped, and str() of other parts.
+        Scripts themselves are parts of the key, so a change of the processing code invalidates the cache.
+        """
+        hasher = hashlib.blake2b(digest_size=20)
+        hash_file(hasher, Path(__file__))
+
+        for part in parts:
+            if part is None:
+                hasher.update(b"N")
+            elif isinstance(part, Path):
+                hasher.update(b"F")
+                hash_file(hasher, part)
+            else:
+                value = str(part).encode(DEFAULT_ENCODING)
+                hasher.update(b"S%d:" % len(value))
+                hasher.update(value)
+
+        return hasher.hexdigest()
+
+    def restore(self, key: str, outputs: dict) -> bool:
+        """
+        Copies the files of an entry to output paths by their names.
+        A name stored as a list of files is restored into the output directory.
+        """
+        entry_dir = self.cache_dir / key
+        if not entry_dir.is_dir():
+            logging.info(f"Processed report is not cached: {key}")
+            return False
+
+        try:
+            for name, output_path in outputs.items():
+                cached_path = entry_dir / name
+                if cached_path.is_dir():
+                    output_path.mkdir(parents=True, exist_ok=True)
+                    for cached_file in cached_path.iterdir():
+                        shutil.copyfile(cached_file, output_path / cached_file.name)
+                else:
+                    shutil.copyfile(cached_path, output_path)
+
+            # The modification time of an entry is its last use time
+            os.utime(entry_dir)
+        except OSError as e:
+            # The entry may be evicted by a concurrent run, outputs are then produced from scratch
+            logging.warning(f"Failed to restore processed report from cache: {e}")
+            return False
+
+        logging.info(f"Restored processed report from cache: {key}")
+        return True
+
+    def store(self, key: str, outputs: dict) -> None:
+        """Stores output files by their names, a list of files is stored as a directory."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry_dir = self.cache_dir / key
+
+        # Entries are published by a rename, so a concurrent run never sees a partial one
+        tmp_dir = Path(tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir))
+        try:
+            for name, output in outputs.items():
+                if isinstance(output, list):
+                    (tmp_dir / name).mkdir()
+                    for output_path in output:
+                        shutil.copyfile(output_path, tmp_dir / name / output_path.name)
+                else:
+                    shutil.copyfile(output, tmp_dir / name)
+
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # The same entry may be already stored by a concurrent run
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not entry_dir.is_dir():
+                raise
+
+        logging.info(f"Stored processed report in cache: {key}")
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        total_size = 0
+        for entry_dir in self.cache_dir.iterdir():
+            if entry_dir.name.startswith(".tmp-") or not entry_dir.is_dir():
+                continue
+
+            size = sum(file_path.stat().st_size for file_path in entry_dir.rglob("*") if file_path.is_file())
+            entries.append((entry_dir.stat().st_mtime, size, entry_dir))
+            total_size += size
+
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+            logging.info(f"Evicted processed report from cache: {entry_dir.name}")
+
+
+def add_metrics_args(parser) -> None:
+    parser.add_argument(
+        "--metrics-path",
+        type=Path,
+        dest="metrics_path",
+        help="Path to a JSON file with phase timings and counters of the run",
+    )
+
+    parser.add_argument(
+        "--profile-path",
+        type=Path,
+        dest="profile_path",
+        help="Path to a cProfile dump of the run, it can be read with pstats or snakeviz",
+    )
+
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        dest="trace_memory",
+        help="Record peak Python memory of every phase with tracemalloc, it slows the run down",
+    )
+
+
+class Metrics:
+    """
+    Phase timings and counters of a run. Used as a context manager, it optionally profiles the run
+    and traces memory, and writes the results to a JSON file on exit, even if the run fails.
+    Without any output it only sums up timings, so it can be passed to processing functions unconditionally.
+    """
+
+    def __init__(self, name: str, metrics_path: Path = None, profile_path: Path = None, trace_memory: bool = False):
+        self.name = name
+        self.metrics_path = metrics_path
+        self.profile_path = profile_path
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self.counters = {}
+        self._started = None
+        self._profiler = None
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.profile_path:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        self._children_cpu_started = get_children_cpu_seconds()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        total_seconds = time.perf_counter() - self._started
+        cpu_seconds = time.process_time() - self._cpu_started
+
+        if self._profiler:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            logging.info(f"Saved profile to {self.profile_path}")
+
+        peak_memory = None
+        if self.trace_memory:
+            peak_memory = max([phase.get("peak_memory_bytes", 0) for phase in self.phases.values()], default=0)
+            peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        if self.metrics_path:
+            metrics = {
+                "name": self.name,
+                "failed": exc_type is not None,
+                "total_seconds": round(total_seconds, 6),
+                "cpu_seconds": round(cpu_seconds, 6),
+                "phases": self.phases,
+                "counters": self.counters,
+                "max_rss_bytes": get_max_rss(),
+                "json_backend": JSON_BACKEND,
+            }
+            if peak_memory is not None:
+                metrics["peak_memory_bytes"] = peak_memory
+
+            # CPU time of finished worker processes
+            children_cpu_seconds = get_children_cpu_seconds()
+            if children_cpu_seconds is not None:
+                metrics["children_cpu_seconds"] = round(children_cpu_seconds - self._children_cpu_started, 6)
+
+            save_compact_json(self.metrics_path, metrics)
+            logging.info(f"Saved metrics to {self.metrics_path}")
+
+    @contextmanager
+    def phase(self, name: str):
+        """Times a phase, a phase entered several times accumulates its time and keeps its highest memory peak."""
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+            phase["seconds"] = round(phase["seconds"] + time.perf_counter() - started, 6)
+            phase["calls"] += 1
+            if self.trace_memory:
+                phase["peak_memory_bytes"] = max(phase.get("peak_memory_bytes", 0), tracemalloc.get_traced_memory()[1])
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def count_bytes(self, paths) -> None:
+        """Adds the sizes of written files to the bytes_written counter."""
+        self.count("bytes_written", sum(os.path.getsize(path_) for path_ in paths))
+
+
+def write_insight_reports(annotations, insight_report: dict, report_output_path: Path) -> list:
+    """Writes the insight report of AnnotationsWriter or the reports of ShardedAnnotationsWriter, returns all outputs."""
+    if isinstance(annotations, ShardedAnnotationsWriter):
+        annotations.write_reports(insight_report)
+        return annotations.files
+
+    save_compact_json(report_output_path, insight_report)
+    return [report_output_path, annotations.path]
+
+
+def restore_cached(
+    cache: ReportCache,
+    key: str,
+    shards_dir: Path,
+    report_output_path: Path,
+    annotations_output_path: Path,
+    extra_outputs: dict,
+    metrics: Metrics,
+) -> bool:
+    """Restores the outputs of a processed report, either shards or a report with annotations, plus extra outputs."""
+    if shards_dir:
+        outputs = {"shards": shards_dir}
+    else:
+        outputs = {"report": report_output_path, "annotations": annotations_output_path}
+    outputs.update(extra_outputs)
+
+    with metrics.phase("cache"):
+        is_restored = cache.restore(key, outputs)
+    metrics.count("cache_hits" if is_restored else "cache_misses")
+    return is_restored
+
+
+def store_cached(
+    cache: ReportCache, key: str, annotations, report_output_path: Path, extra_outputs: dict, metrics: Metrics
+) -> None:
+    """Stores the outputs written by write_insight_reports under the names used by restore_cached."""
+    if isinstance(annotations, ShardedAnnotationsWriter):
+        outputs = {"shards": annotations.files}
+    else:
+        outputs = {"report": report_output_path, "annotations": annotations.path}
+    outputs.update(extra_outputs)
+
+    with metrics.phase("cache"):
+        cache.store(key, outputs)
+
+
+def get_max_rss():
+    """Returns peak resident memory of the process in bytes, it includes memory of the interpreter and C extensions."""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def get_children_cpu_seconds():
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def get_mp_context():
+    """
+    Returns the fork context on Linux, where forked workers skip interpreter startup and the imports already done
+    by the parent. On macOS forked children may crash if system libraries have started threads, so None keeps
+    the default spawn method there. Outputs don't depend on the start method.
+    """
+    if sys.platform.startswith("linux"):
+        return multiprocessing.get_context("fork")
+    return None
+
+
+def hash_file(hasher, path_: Path) -> None:
+    with open(path_, mode="rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        hasher.update(b"%d:" % size)
+        # Empty files can not be memory mapped
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                hasher.update(data)
@@ -0,0 +1,209 @@
+# SPDX-FileCopyrightText: AdGuard Software Limited
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import quote
+
+from report_common import SHARDS_MANIFEST_NAME, Metrics, ShardedAnnotationsWriter, dumps_compact, load_json
+
+# Bitbucket access token, it is not passed in the command line so it isn't visible in the process list
+UPLOAD_TOKEN_ENV = "BITBUCKET_TOKEN"
+
+DEFAULT_UPLOAD_JOBS = 4
+DEFAULT_UPLOAD_RETRIES = 5
+# Seconds to connect and to wait for a response
+DEFAULT_UPLOAD_TIMEOUT = 60
+
+# Responses retried with a backoff. Putting a report is idempotent, so it is also retried on gateway errors.
+# Adding annotations is not: after a gateway error or a read error the server may have already added them,
+# so it is retried only on responses which mean the request was not processed
+RETRY_STATUSES = (429, 502, 503, 504)
+POST_RETRY_STATUSES = (429, 503)
+RETRY_BACKOFF_FACTOR = 0.5
+
+
+def create_retry(retries: int):
+    """
+    Returns a retry policy which retries a PUT on RETRY_STATUSES and read errors, a POST only on
+    POST_RETRY_STATUSES and connection errors. urllib3 is imported here, so it isn't loaded without uploads.
+    """
+    from urllib3.util.retry import Retry
+
+    class UploadRetry(Retry):
+        def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+            if method.upper() == "POST" and status_code not in POST_RETRY_STATUSES:
+                return False
+            return super().is_retry(method, status_code, has_retry_after)
+
+        def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+            if error and method and method.upper() == "POST" and self._is_read_error(error):
+                raise error
+            return super().increment(method, url, response, error, _pool, _stacktrace)
+
+    return UploadRetry(
+        total=retries,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"PUT", "POST"}),
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        raise_on_status=False,
+    )
+
+
+def add_upload_args(parser) -> None:
+    parser.add_argument(
+        "--upload-url",
+        dest="upload_url",
+        help="Bitbucket server URL. If set, insight reports and annotations are uploaded after the conversion "
+        f"using the token from the {UPLOAD_TOKEN_ENV} environment variable. Requires --insight-key",
+    )
+
+    parser.add_argument("--project-key", dest="project_key", help="Bitbucket project key to upload to")
+
+    parser.add_argument("--repository", dest="repository", help="Bitbucket repository slug to upload to")
+
+    parser.add_argument("--commit-id", dest="commit_id", help="Commit to upload insight reports for")
+
+    parser.add_argument(
+        "--upload-jobs",
+        type=int,
+        dest="upload_jobs",
+        default=DEFAULT_UPLOAD_JOBS,
+        help="Number of concurrent upload requests",
+    )
+
+
+def get_uploader(args):
+    """Returns an uploader configured by the arguments of add_upload_args, None if uploading is not requested."""
+    if not args.upload_url:
+        return None
+
+    for name, value in (
+        ("Project key", args.project_key),
+        ("Repository", args.repository),
+        ("Commit id", args.commit_id),
+        ("Insight key", args.insight_key),
+    ):
+        if not value:
+            raise ValueError(f"{name} is not given")
+
+    token = os.environ.get(UPLOAD_TOKEN_ENV)
+    if not token:
+        raise ValueError(f"Bitbucket token is not set in {UPLOAD_TOKEN_ENV}")
+
+    return InsightsUploader(args.upload_url, args.project_key, args.repository, args.commit_id, token, args.upload_jobs)
+
+
+def load_uploads(insight_key: str, shards_dir: Path = None, report_path: Path = None, annotations_path: Path = None):
+    """
+    Reads uploads of reports written earlier, e.g. restored from the cache.
+    An upload is (insight key, encoded report, encoded annotations, annotations count).
+    """
+    if not shards_dir:
+        annotations = annotations_path.read_bytes()
+        return [(insight_key, report_path.read_bytes(), annotations, len(load_json(annotations_path)["annotations"]))]
+
+    manifest = load_json(shards_dir / SHARDS_MANIFEST_NAME)
+    return [
+        (
+            shard["insight_key"],
+            (shards_dir / shard["report"]).read_bytes(),
+            (shards_dir / shard["annotations"]).read_bytes(),
+            shard["annotations_count"],
+        )
+        for shard in manifest["shards"]
+    ]
+
+
+def build_uploads(annotations, insight_report: dict, insight_key: str) -> list:
+    """
+    Returns uploads of reports just written by write_insight_reports. Annotations are taken from the bodies kept
+    by the annotations writer, so the written files are not read back.
+    """
+    if isinstance(annotations, ShardedAnnotationsWriter):
+        return annotations.uploads
+    return [(insight_key, dumps_compact(insight_report), bytes(annotations.body), annotations.count)]
+
+
+class InsightsUploader:
+    """
+    Uploads insight reports and their annotations to the Bitbucket Insights REST API. Requests share one session,
+    so connections are kept alive between them, and are sent by a thread pool. Bodies are sent from memory as they
+    were encoded by the annotations writers.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        project_key: str,
+        repository: str,
+        commit_id: str,
+        token: str,
+        jobs: int = DEFAULT_UPLOAD_JOBS,
+        retries: int = DEFAULT_UPLOAD_RETRIES,
+        timeout: int = DEFAULT_UPLOAD_TIMEOUT,
+    ):
+        # requests takes a noticeable part of the startup time and is installed only where reports are uploaded,
+        # so it is imported only when they are
+        try:
+            import requests
+            from requests.adapters import HTTPAdapter
+        except ImportError:
+            raise ValueError("Uploading insight reports requires the requests package") from None
+
+        self.commit_url = (
+            f"{base_url.rstrip('/')}/rest/insights/1.0/projects/{quote(project_key, safe='')}"
+            f"/repos/{quote(repository, safe='')}/commits/{quote(commit_id, safe='')}"
+        )
+        self.jobs = max(jobs, 1)
+        self.timeout = timeout
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.jobs, max_retries=create_retry(retries))
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
+
+    def get_report_url(self, insight_key: str) -> str:
+        return f"{self.commit_url}/reports/{quote(insight_key, safe='')}"
+
+    def send(self, method: str, url: str, body: bytes) -> None:
+        response = self.session.request(method, url, data=body, timeout=self.timeout)
+        if not response.ok:
+            raise ValueError(f"{method} {url} failed with {response.status_code}: {response.text[:1000]}")
+
+    def put_report(self, upload: tuple) -> None:
+        insight_key, report, _, _ = upload
+        self.send("PUT", self.get_report_url(insight_key), report)
+        logging.info(f"Uploaded insight report: {insight_key}")
+
+    def post_annotations(self, upload: tuple) -> None:
+        insight_key, _, annotations, annotations_count = upload
+        self.send("POST", f"{self.get_report_url(insight_key)}/annotations", annotations)
+        logging.info(f"Uploaded {annotations_count} annotations: {insight_key}")
+
+    def upload(self, uploads: list, metrics: Metrics = None) -> None:
+        """
+        Uploads (insight key, encoded report, encoded annotations, annotations count) tuples and closes the session.
+        Annotations are added to an existing report and replacing a report deletes its annotations,
+        so all reports are put first.
+        """
+        metrics = metrics or Metrics("upload")
+        annotated = [upload for upload in uploads if upload[3]]
+
+        try:
+            with metrics.phase("upload"), ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                # list() waits for the requests and raises the first error
+                list(pool.map(self.put_report, uploads))
+                list(pool.map(self.post_annotations, annotated))
+        finally:
+            self.session.close()
+
+        metrics.count("upload_requests", len(uploads) + len(annotated))
+        metrics.count(
+            "upload_bytes",
+            sum(len(report) for _, report, _, _ in uploads) + sum(len(upload[2]) for upload in annotated),
+        )
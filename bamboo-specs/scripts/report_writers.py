@@ -0,0 +1,246 @@
+# SPDX-FileCopyrightText: AdGuard Software Limited
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import logging
+import re
+from contextlib import ExitStack
+from pathlib import Path
+from urllib.parse import quote
+
+from report_common import DEFAULT_ENCODING, dumps_compact
+
+SARIF_SCHEMA = "https://json.schemastore.org/sarif-2.1.0.json"
+SARIF_VERSION = "2.1.0"
+
+# Annotation severities in terms of each format
+SARIF_LEVELS = {"HIGH": "error", "MEDIUM": "warning", "LOW": "note"}
+CHECKSTYLE_SEVERITIES = {"HIGH": "error", "MEDIUM": "warning", "LOW": "info"}
+
+# Characters not allowed in XML 1.0 documents, even as character references
+XML_INVALID_CHARS_REGEX = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+# Width reserved in the JUnit start tags for the counts, which are known only at the end
+JUNIT_COUNTS_WIDTH = 64
+
+
+def escape_xml(value) -> str:
+    """Escapes a value for XML text or a double-quoted attribute, line breaks are kept as references."""
+    value = XML_INVALID_CHARS_REGEX.sub("", str(value))
+    return (
+        value.replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace(">", "&gt;")
+        .replace('"', "&quot;")
+        .replace("\n", "&#10;")
+        .replace("\r", "&#13;")
+        .replace("\t", "&#9;")
+    )
+
+
+class SarifWriter:
+    """
+    Writes results to a SARIF 2.1.0 log one by one. The rules of the tool are known only after the last result,
+    so the tool object follows the results, the order of keys doesn't matter in JSON.
+    """
+
+    def __init__(self, path_: Path, tool_name: str):
+        self.path = path_
+        self.tool_name = tool_name
+        self.count = 0
+        self._rules = {}
+        # Annotations of a file are usually many, so its quoted URI is reused
+        self._uris = {}
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, mode="wb")
+        self._file.write(
+            b'{"$schema":%s,"version":%s,"runs":[{"results":['
+            % (dumps_compact(SARIF_SCHEMA), dumps_compact(SARIF_VERSION))
+        )
+        return self
+
+    def write(self, annotation: dict, rule_id: str) -> None:
+        uri = self._uris.get(annotation["path"])
+        if uri is None:
+            uri = self._uris[annotation["path"]] = quote(annotation["path"])
+
+        region = {} if annotation["line"] is None else {"region": {"startLine": annotation["line"]}}
+        result = {
+            "ruleId": rule_id,
+            "ruleIndex": self._rules.setdefault(rule_id, len(self._rules)),
+            "level": SARIF_LEVELS[annotation["severity"]],
+            "message": {"text": annotation["message"]},
+            "locations": [{"physicalLocation": {"artifactLocation": {"uri": uri}, **region}}],
+        }
+
+        if self.count:
+            self._file.write(b",")
+        self._file.write(dumps_compact(result))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        tool = {"driver": {"name": self.tool_name, "rules": [{"id": rule_id} for rule_id in self._rules]}}
+        self._file.write(b'],"tool":%s}]}' % dumps_compact(tool))
+        self._file.close()
+
+
+class JUnitWriter:
+    """
+    Writes every annotation as a failed test case of a single test suite. Counts of tests are attributes
+    of the start tags, so space is reserved for them and they are written over it when the suite is closed.
+    """
+
+    def __init__(self, path_: Path, tool_name: str):
+        self.path = path_
+        self.tool_name = tool_name
+        self.count = 0
+        self._counts_offsets = []
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, mode="wb")
+        self._file.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        self._write_start_tag(f'<testsuites name="{escape_xml(self.tool_name)}"')
+        self._write_start_tag(f'\n<testsuite name="{escape_xml(self.tool_name)}" errors="0" skipped="0"')
+        self._file.write(b"\n")
+        return self
+
+    def _write_start_tag(self, text: str) -> None:
+        self._file.write(text.encode(DEFAULT_ENCODING))
+        self._counts_offsets.append(self._file.tell())
+        self._file.write(b" " * JUNIT_COUNTS_WIDTH + b">")
+
+    def write(self, annotation: dict, rule_id: str) -> None:
+        location = annotation["path"] if annotation["line"] is None else f"{annotation['path']}:{annotation['line']}"
+        message = escape_xml(annotation["message"])
+        self._file.write(
+            f'<testcase classname="{escape_xml(annotation["path"])}" name="{escape_xml(f"{rule_id} at {location}")}">'
+            f'<failure type="{annotation["severity"]}" message="{message}">{message}</failure>'
+            f"</testcase>\n".encode(DEFAULT_ENCODING)
+        )
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.write(b"</testsuite>\n</testsuites>\n")
+
+        counts = f' tests="{self.count}" failures="{self.count}"'.ljust(JUNIT_COUNTS_WIDTH).encode()
+        for offset in self._counts_offsets:
+            self._file.seek(offset)
+            self._file.write(counts)
+        self._file.close()
+
+
+class CheckstyleWriter:
+    """Writes a checkstyle XML report, consecutive annotations of a file are grouped into one file element."""
+
+    def __init__(self, path_: Path, tool_name: str):
+        self.path = path_
+        self.tool_name = tool_name
+        self.count = 0
+        self._current_path = None
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, mode="wb")
+        self._file.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<checkstyle version="4.3">\n')
+        return self
+
+    def write(self, annotation: dict, rule_id: str) -> None:
+        text = ""
+        if annotation["path"] != self._current_path:
+            if self._current_path is not None:
+                text = "</file>\n"
+            text += f'<file name="{escape_xml(annotation["path"])}">\n'
+            self._current_path = annotation["path"]
+
+        line = "" if annotation["line"] is None else f' line="{annotation["line"]}"'
+        text += (
+            f"<error{line}"
+            f' severity="{CHECKSTYLE_SEVERITIES[annotation["severity"]]}"'
+            f' message="{escape_xml(annotation["message"])}"'
+            f' source="{escape_xml(f"{self.tool_name}.{rule_id}")}"/>\n'
+        )
+        self._file.write(text.encode(DEFAULT_ENCODING))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._current_path is not None:
+            self._file.write(b"</file>\n")
+        self._file.write(b"</checkstyle>\n")
+        self._file.close()
+
+
+# Output formats of --output besides the Bitbucket insight report and annotations
+WRITERS = {
+    "sarif": SarifWriter,
+    "junit": JUnitWriter,
+    "checkstyle": CheckstyleWriter,
+}
+
+
+def parse_output(value: str):
+    """Parses a FORMAT=PATH value of --output."""
+    output_format, separator, output_path = value.partition("=")
+    if not separator or not output_path:
+        raise argparse.ArgumentTypeError(f"Expected FORMAT=PATH, got '{value}'")
+    if output_format not in WRITERS:
+        raise argparse.ArgumentTypeError(
+            f"Unknown output format '{output_format}', expected one of: {', '.join(WRITERS)}"
+        )
+    return output_format, Path(output_path)
+
+
+def add_output_args(parser) -> None:
+    parser.add_argument(
+        "--output",
+        type=parse_output,
+        action="append",
+        dest="outputs",
+        default=[],
+        metavar="FORMAT=PATH",
+        help=f"Additional output written in the same pass, one of: {', '.join(WRITERS)}. Can be repeated",
+    )
+
+
+class OutputWriters:
+    """Opens the writers of additional outputs and passes every annotation to all of them."""
+
+    def __init__(self, outputs: list, tool_name: str):
+        self.outputs = outputs
+        self.writers = [WRITERS[output_format](output_path, tool_name) for output_format, output_path in outputs]
+        self._stack = None
+
+    def __bool__(self):
+        return bool(self.writers)
+
+    def get_cache_key_parts(self) -> tuple:
+        """Returns parts of a cache key for the requested formats, the key doesn't change without them."""
+        if not self.outputs:
+            return ()
+        return Path(__file__), ",".join(output_format for output_format, _ in self.outputs)
+
+    def get_cache_outputs(self) -> dict:
+        """Returns names of the output files in a cache entry."""
+        return {
+            f"output-{index}-{output_format}": output_path
+            for index, (output_format, output_path) in enumerate(self.outputs)
+        }
+
+    def __enter__(self):
+        self._stack = ExitStack().__enter__()
+        for writer in self.writers:
+            self._stack.enter_context(writer)
+        return self
+
+    def write(self, annotation: dict, rule_id: str) -> None:
+        for writer in self.writers:
+            writer.write(annotation, rule_id)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stack.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            for output_format, output_path in self.outputs:
+                logging.info(f"Saved {output_format} report: {output_path}")
@@ -0,0 +1,105 @@
+# SPDX-FileCopyrightText: AdGuard Software Limited
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import importlib
+import logging
+import os
+import shlex
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from report_common import get_mp_context
+
+# Modules are imported only when a job of their kind runs, so a linter-only run never loads lxml
+JOB_MODULES = {
+    "linter": "create_linter_report",
+    "reuse": "create_reuse_report",
+    "appcast": "update_appcast",
+}
+
+
+def configure_logging() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run several report and appcast jobs in one interpreter.",
+        epilog='Example: --job "linter --report-path swiftlint.json --root-path ." --job "reuse --report-path reuse.json"',
+    )
+
+    parser.add_argument(
+        "--job",
+        dest="jobs",
+        action="append",
+        required=True,
+        help=f"Job kind ({', '.join(JOB_MODULES)}) followed by the arguments of its script. Can be repeated",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        dest="workers",
+        help="Number of processes running independent jobs. Defaults to the number of jobs limited by CPU count",
+    )
+
+    return parser.parse_args(argv)
+
+
+def parse_job(spec: str):
+    kind, *argv = shlex.split(spec)
+    if kind not in JOB_MODULES:
+        raise ValueError(f"Unknown job kind '{kind}', expected one of: {', '.join(JOB_MODULES)}")
+    return kind, argv
+
+
+def run_job(spec: str) -> bool:
+    """Runs a job in the current process and returns whether it succeeded."""
+    kind, argv = parse_job(spec)
+    started = time.perf_counter()
+
+    try:
+        importlib.import_module(JOB_MODULES[kind]).main(argv)
+    except SystemExit as e:
+        # argparse exits on invalid arguments, it must not stop the other jobs
+        if e.code:
+            logging.error(f"Job '{kind}' exited with code {e.code}")
+            return False
+    except Exception:
+        logging.exception(f"Job '{kind}' failed")
+        return False
+
+    logging.info(f"Job '{kind}' finished in {time.perf_counter() - started:.2f} s")
+    return True
+
+
+def run_jobs(jobs, workers=None) -> bool:
+    # Validate all specs before starting anything
+    for spec in jobs:
+        parse_job(spec)
+
+    workers = workers or min(len(jobs), os.cpu_count() or 1)
+    if len(jobs) == 1 or workers == 1:
+        return all([run_job(spec) for spec in jobs])
+
+    # Spawned workers start without the logging setup of the parent, forked ones already have it
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=get_mp_context(), initializer=configure_logging
+    ) as executor:
+        return all(executor.map(run_job, jobs))
+
+
+def main(argv=None):
+    args = get_args(argv)
+
+    if not run_jobs(args.jobs, args.workers):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    configure_logging()
+
+    main()
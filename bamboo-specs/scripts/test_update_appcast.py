@@ -0,0 +1,70 @@
+# SPDX-FileCopyrightText: AdGuard Software Limited
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Golden-file tests of the appcast serializer. The expected output was produced by the minidom based format_xml
+which the serializer replaced. Run from this directory: python3 -m unittest test_update_appcast
+"""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+from update_appcast import (
+    ITEM_XPATH,
+    RELEASE_NOTES_TAG,
+    SPARKLE_NAMESPACE,
+    FeedWriter,
+    load_xml,
+    restore_cdata,
+    write_xml,
+)
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+FEED_PATH = FIXTURES_DIR / "appcast.xml"
+EXPECTED_PATH = FIXTURES_DIR / "appcast_expected.xml"
+
+NAMESPACES = {"sparkle": SPARKLE_NAMESPACE}
+
+
+def load_feed():
+    """Load the fixture feed with release notes links wrapped into CDATA, as process_xml does."""
+    tree = load_xml(FEED_PATH)
+    items = tree.xpath(ITEM_XPATH, namespaces=NAMESPACES)
+    for item in items:
+        restore_cdata(item, NAMESPACES)
+    return tree, items
+
+
+class SerializerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.output_path = Path(self.tmp_dir.name) / "appcast.xml"
+        self.expected = EXPECTED_PATH.read_text(encoding="utf-8")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write_xml(self):
+        tree, _ = load_feed()
+        write_xml(tree, self.output_path)
+
+        self.assertEqual(self.output_path.read_text(encoding="utf-8"), self.expected)
+
+    def test_feed_writer(self):
+        tree, items = load_feed()
+        channel = items[0].getparent()
+        for item in items:
+            channel.remove(item)
+
+        with FeedWriter(self.output_path, tree, channel, True, frozenset({RELEASE_NOTES_TAG})) as writer:
+            for item in items:
+                writer.write_item(item)
+        writer.commit()
+
+        self.assertEqual(self.output_path.read_text(encoding="utf-8"), self.expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,22 +3,45 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import argparse
+import contextlib
+import hashlib
+import io
 import logging
+import os
+from array import array
 from lxml import etree
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from email.utils import mktime_tz, parsedate_tz
+from operator import itemgetter
 import copy
-import re
-from xml.dom import minidom
+
+from report_common import Metrics, add_metrics_args
 
 DEFAULT_ENCODING = "UTF-8"
 
+SPARKLE_NAMESPACE = "http://www.andymatuschak.org/xml-namespaces/sparkle"
+XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
+
 ITEM_XPATH = "//rss/channel/item"
 CHANNEL_XPATH = "sparkle:channel"
 RELEASE_NOTES_XPATH = "sparkle:releaseNotesLink/text()"
+RELEASE_NOTES_TAG = f"{{{SPARKLE_NAMESPACE}}}releaseNotesLink"
+
+XML_DECLARATION = '<?xml version="1.0" standalone="yes" ?>'
+INDENT = "    "
+
+# Sort key of items without a valid <pubDate>, they go last
+MISSING_PUBDATE_KEY = float("-inf")
 
+# Size of text collected before it is split into lines and written to a file
+WRITE_BUFFER_SIZE = 64 * 1024
 
-def get_args():
+# Element standing for the items of a channel when the rest of a feed is serialized in the streaming mode
+ITEMS_MARKER_TAG = "appcast-stream-items"
+
+
+def get_args(argv=None):
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description="Replace <item> elements based on <sparkle:channel> and sort by <pubDate>.")
 
@@ -38,7 +61,60 @@ def get_args():
         help="Path to the target XML file"
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--keep-per-channel",
+        type=int,
+        dest="keep_per_channel",
+        help="Number of the latest items to keep for each <sparkle:channel>, older ones are pruned"
+    )
+
+    parser.add_argument(
+        "--max-age-days",
+        type=int,
+        dest="max_age_days",
+        help="Prune items with <pubDate> older than this number of days"
+    )
+
+    parser.add_argument(
+        "--archive-path",
+        type=Path,
+        dest="archive_path",
+        help="Path to the XML file where pruned items are appended"
+    )
+
+    parser.add_argument(
+        "--latest-path",
+        type=Path,
+        dest="latest_path",
+        help="Path to the XML file with only the latest item of each <sparkle:channel>, "
+        "its ETag is written next to it with the .etag suffix"
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        dest="stream",
+        help="Merge item by item to keep memory usage constant, the target items must be sorted by <pubDate>"
+    )
+
+    add_metrics_args(parser)
+
+    args = parser.parse_args(argv)
+    try:
+        validate_prune_args(args.keep_per_channel, args.max_age_days)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+def validate_prune_args(keep_per_channel: int = None, max_age_days: int = None):
+    """Raise an exception if pruning would remove the items every client is updated to."""
+    if keep_per_channel is not None and keep_per_channel < 1:
+        raise ValueError(f"Number of items to keep per channel must be at least 1, got {keep_per_channel}")
+
+    # A negative age puts the cutoff in the future, so every dated item would be pruned
+    if max_age_days is not None and max_age_days < 0:
+        raise ValueError(f"Maximum age of items in days must not be negative, got {max_age_days}")
 
 
 def validate_file_exists(file_path: Path, file_name: str):
@@ -57,12 +133,26 @@ def load_xml(file_path: Path):
         raise
 
 
-def parse_pubdate(item, namespaces):
-    """Extract pubDate from an item and return it as a datetime object for sorting."""
-    pubdate_str = item.xpath("pubDate/text()")
-    if pubdate_str:
-        return datetime.strptime(pubdate_str[0], "%a, %d %b %Y %H:%M:%S %z")
-    return datetime.min  # return a very early date if no pubDate is found
+def get_pubdate_key(item):
+    """Extract pubDate from an item and return it as UTC epoch seconds for sorting."""
+    pubdate_str = item.findtext("pubDate")
+    if not pubdate_str:
+        return MISSING_PUBDATE_KEY
+
+    # RFC 2822 parser, unlike strptime it doesn't depend on locale. A date without a timezone is taken as UTC
+    pubdate = parsedate_tz(pubdate_str)
+    if pubdate is None:
+        logging.warning(f"Invalid <pubDate>, the item is sorted last: {pubdate_str}")
+        return MISSING_PUBDATE_KEY
+
+    return mktime_tz(pubdate)
+
+
+def sort_items(items):
+    """Return (pubDate key, item) pairs sorted latest first, keys are computed once per item."""
+    keyed_items = [(get_pubdate_key(item), item) for item in items]
+    keyed_items.sort(key=itemgetter(0), reverse=True)
+    return keyed_items
 
 
 def preserve_cdata(item, namespaces):
@@ -71,79 +161,378 @@ def preserve_cdata(item, namespaces):
     return cdata_content[0].strip() if cdata_content else ""
 
 
-def remove_empty_lines(xml_str):
-    """Remove empty lines from XML string."""
-    return "\n".join([line for line in xml_str.splitlines() if line.strip()])
+def restore_cdata(item, namespaces):
+    """Put the stripped sparkle:releaseNotesLink content back as CDATA."""
+    cdata_content = preserve_cdata(item, namespaces)
+    if cdata_content:
+        release_notes_link = item.xpath("sparkle:releaseNotesLink", namespaces=namespaces)
+        if release_notes_link:
+            release_notes_link[0].text = etree.CDATA(cdata_content)
+
+
+def get_channel_value(item, namespaces):
+    """Return the stripped <sparkle:channel> value of an item or None if it has no channel."""
+    channel_value = item.xpath(f"{CHANNEL_XPATH}/text()", namespaces=namespaces)
+    return channel_value[0].strip() if channel_value else None
+
+
+def get_indexed_channels(item, namespaces):
+    """Return values an item is matched by, i.e. string values of all its <sparkle:channel> elements or None."""
+    channels = item.xpath(CHANNEL_XPATH, namespaces=namespaces)
+    if not channels:
+        return {None}
+    return {"".join(channel.itertext()) for channel in channels}
+
+
+def index_items(items, namespaces):
+    """Group items by the channel values they are matched by, keeping document order."""
+    index = {}
+    for item in items:
+        add_to_index(index, item, namespaces)
+    return index
+
+
+def add_to_index(index, item, namespaces):
+    for channel_value in get_indexed_channels(item, namespaces):
+        index.setdefault(channel_value, {})[item] = None
+
 
+def remove_from_index(index, item, namespaces):
+    for channel_value in get_indexed_channels(item, namespaces):
+        index[channel_value].pop(item, None)
 
-def replace_or_add_item(source_item, target_tree, namespaces):
-    """Replace an item in the target tree if it exists, otherwise add it."""
-    channel_value = source_item.xpath(f"{CHANNEL_XPATH}/text()", namespaces=namespaces)
-    channel_value = channel_value[0].strip() if channel_value else None
+
+def replace_or_add_item(source_item, channel_element, index, namespaces):
+    """Replace matching items in the target channel if they exist, otherwise add the item."""
+    channel_value = get_channel_value(source_item, namespaces)
 
     if channel_value:
         logging.info(f"Processing <item> with <sparkle:channel>: {channel_value}")
-        target_items = target_tree.xpath(f"//rss/channel/item[sparkle:channel='{channel_value}']", namespaces=namespaces)
     else:
         logging.info("Processing <item> without <sparkle:channel>")
-        target_items = target_tree.xpath("//rss/channel/item[not(sparkle:channel)]", namespaces=namespaces)
 
-    channel_element = target_tree.xpath("//rss/channel", namespaces=namespaces)[0]
+    # An empty channel value is handled as a missing channel
+    target_items = list(index.get(channel_value or None, {}))
 
     if target_items:
         for target_item in target_items:
             logging.info(f"Replacing item{' with channel: ' + channel_value if channel_value else ''}")
             new_item = copy.deepcopy(source_item)
             target_item.getparent().replace(target_item, new_item)
+            remove_from_index(index, target_item, namespaces)
+            add_to_index(index, new_item, namespaces)
     else:
         logging.info(f"No matching item found. Adding new item{' with channel: ' + channel_value if channel_value else ''}")
         new_item = copy.deepcopy(source_item)
         channel_element.append(new_item)
+        add_to_index(index, new_item, namespaces)
 
 
 def process_items(source_items, target_tree, namespaces):
     """Process and replace <item> elements in the target XML based on source items."""
+    channel_element = target_tree.xpath("//rss/channel", namespaces=namespaces)[0]
+    index = index_items(target_tree.xpath(ITEM_XPATH, namespaces=namespaces), namespaces)
+
     for source_item in source_items:
-        replace_or_add_item(source_item, target_tree, namespaces)
+        replace_or_add_item(source_item, channel_element, index, namespaces)
 
 
-def format_xml(tree):
-    """Format the XML string with proper indentation and CDATA handling."""
-    xml_str = etree.tostring(tree, encoding=DEFAULT_ENCODING, xml_declaration=True, method="xml").decode()
-    pretty_xml = minidom.parseString(xml_str).toprettyxml(indent="    ")
+class LineFilterWriter:
+    """Write text to a file dropping whitespace-only lines, lines are joined by a newline without a trailing one."""
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = []
+        self.buffered_size = 0
+        self.pending = ""
+        self.has_lines = False
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered_size += len(text)
+        if self.buffered_size >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        # The sentinel is left alone in the last line if the text ends with a line break
+        lines = (self.pending + "".join(self.buffer) + "x").splitlines()
+        self.pending = lines.pop()[:-1]
+        self.buffer = []
+        self.buffered_size = 0
+        self._write_lines(lines)
+
+    def _write_lines(self, lines):
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return
+
+        if self.has_lines:
+            self.file.write("\n")
+        self.file.write("\n".join(lines))
+        self.has_lines = True
+
+    def close(self):
+        self.flush()
+        self._write_lines([self.pending])
+        self.pending = ""
+
+
+def escape_data(data):
+    """Escape text and attribute values the same way for both."""
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
 
-    # Format CDATA sections in a more readable way
-    pretty_xml = re.sub(
-        r"(<sparkle:releaseNotesLink>)(<!\[CDATA\[)(.*?)(\]\]>)",
-        r"\1\n                \2\3\4\n            ",
-        pretty_xml
-    )
 
-    # Manually insert the standalone attribute into the XML declaration
-    # Insert 'standalone="yes"' after the XML declaration (before the root tag)
-    pretty_xml = pretty_xml.replace('<?xml version="1.0" ?>', '<?xml version="1.0" standalone="yes" ?>')
+def get_qualified_name(name, nsmap):
+    """Return a prefixed name of an attribute using the namespaces in scope."""
+    if not name.startswith("{"):
+        return name
 
-    # Remove the extra empty lines and maintain the correct indentation
-    return remove_empty_lines(pretty_xml)
+    namespace, localname = name[1:].split("}", 1)
+    if namespace == XML_NAMESPACE:
+        return f"xml:{localname}"
 
+    for prefix, uri in nsmap.items():
+        if prefix and uri == namespace:
+            return f"{prefix}:{localname}"
 
-def process_xml(source_xml_path: Path, target_xml_path: Path):
+    return localname
+
+
+def get_tag_name(element):
+    """Return a prefixed tag name of an element."""
+    tag = element.tag
+    if not tag.startswith("{"):
+        return tag
+
+    localname = tag.split("}", 1)[1]
+    prefix = element.prefix
+    return f"{prefix}:{localname}" if prefix else localname
+
+
+def get_child_nodes(element, cdata_tags):
+    """Return text, CDATA and element children of an element in document order."""
+    nodes = []
+    if element.text:
+        is_cdata = element.tag in cdata_tags and element.text.strip()
+        nodes.append(("cdata" if is_cdata else "text", element.text))
+
+    for child in element:
+        nodes.append(("node", child))
+        if child.tail:
+            nodes.append(("text", child.tail))
+
+    return nodes
+
+
+def write_start_tag(writer, element, indent, nsmap, parent_nsmap):
+    """Write an opening tag with namespace declarations that are new in the element scope, without closing `>`."""
+    parts = [f"{indent}<{get_tag_name(element)}"]
+
+    if nsmap != parent_nsmap:
+        for prefix, uri in nsmap.items():
+            if prefix not in parent_nsmap or parent_nsmap[prefix] != uri:
+                parts.append(f' {"xmlns:" + prefix if prefix else "xmlns"}="{escape_data(uri)}"')
+
+    for name, value in element.attrib.items():
+        parts.append(f' {get_qualified_name(name, nsmap)}="{escape_data(value)}"')
+
+    writer.write("".join(parts))
+
+
+def write_node(writer, node, indent, cdata_tags, parent_nsmap):
+    """Write a node with pretty-printing of xml.dom.minidom."""
+    if isinstance(node, etree._Comment):
+        writer.write(f"{indent}<!--{node.text or ''}-->\n")
+        return
+
+    if isinstance(node, etree._ProcessingInstruction):
+        writer.write(f"{indent}<?{node.target} {node.text or ''}?>\n")
+        return
+
+    nsmap = node.nsmap
+    write_start_tag(writer, node, indent, nsmap, parent_nsmap)
+    nodes = get_child_nodes(node, cdata_tags)
+
+    if not nodes:
+        writer.write("/>\n")
+        return
+
+    writer.write(">")
+    if len(nodes) == 1 and nodes[0][0] == "cdata":
+        data = nodes[0][1]
+        # Parsers turn \r into \n in CDATA
+        if "\n" in data or "\r" in data:
+            writer.write(f"<![CDATA[{data}]]>")
+        else:
+            # Put a single-line CDATA section on its own line for readability
+            writer.write(f"\n{indent}{INDENT}<![CDATA[{data}]]>\n{indent}")
+    elif len(nodes) == 1 and nodes[0][0] == "text":
+        writer.write(escape_data(nodes[0][1]))
+    else:
+        writer.write("\n")
+        child_indent = indent + INDENT
+        for kind, child in nodes:
+            if kind == "text":
+                writer.write(escape_data(f"{child_indent}{child}\n"))
+            elif kind == "cdata":
+                writer.write(f"<![CDATA[{child}]]>")
+            else:
+                write_node(writer, child, child_indent, cdata_tags, nsmap)
+        writer.write(indent)
+    writer.write(f"</{get_tag_name(node)}>\n")
+
+
+def write_tree(writer, tree, cdata_tags):
+    """Write the XML declaration, the document type and all top-level nodes of the tree."""
+    root = tree.getroot()
+    nodes = list(reversed(list(root.itersiblings(preceding=True)))) + [root] + list(root.itersiblings())
+
+    writer.write(f"{XML_DECLARATION}\n")
+    # lxml keeps the name and the external ids of a document type, but not its internal subset
+    if tree.docinfo.doctype:
+        writer.write(f"{tree.docinfo.doctype}\n")
+    for node in nodes:
+        write_node(writer, node, "", cdata_tags, {})
+
+
+def get_tmp_path(file_path: Path) -> Path:
+    """Return a temporary file next to the file, it replaces the file once completely written."""
+    return file_path.with_name(f".{file_path.name}.tmp")
+
+
+def write_xml(tree, file_path: Path, cdata_tags=frozenset({RELEASE_NOTES_TAG})):
+    """
+    Write the XML tree with proper indentation and CDATA handling in a single pass.
+    The file is replaced atomically, so a failed write never truncates an existing feed or archive.
+    """
+    tmp_path = get_tmp_path(file_path)
+    try:
+        with open(tmp_path, "w", encoding=DEFAULT_ENCODING) as f:
+            writer = LineFilterWriter(f)
+            write_tree(writer, tree, cdata_tags)
+            writer.close()
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, file_path)
+
+
+def select_pruned_items(keyed_channels, keep_per_channel=None, max_age_days=None):
+    """
+    Return indices of items to prune by the retention policy.
+    Items are given as (pubDate key, channel value) pairs sorted latest first.
+    """
+    cutoff = None
+    if max_age_days is not None:
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=max_age_days)).timestamp()
+
+    kept_counts = {}
+    pruned_indices = set()
+    for index, (pubdate_key, channel_value) in enumerate(keyed_channels):
+        # Items without <pubDate> are kept as their age is unknown
+        if cutoff is not None and MISSING_PUBDATE_KEY < pubdate_key < cutoff:
+            pruned_indices.add(index)
+            continue
+
+        if keep_per_channel is not None and kept_counts.get(channel_value, 0) >= keep_per_channel:
+            pruned_indices.add(index)
+            continue
+
+        kept_counts[channel_value] = kept_counts.get(channel_value, 0) + 1
+
+    return pruned_indices
+
+
+def create_channel_tree(target_tree, namespaces):
+    """Return a new feed tree without items with the target channel metadata and its channel element."""
+    target_root = target_tree.getroot()
+    archive_root = etree.Element(target_root.tag, attrib=target_root.attrib, nsmap=target_root.nsmap)
+    archive_channel = etree.SubElement(archive_root, "channel")
+    for child in target_tree.xpath("//rss/channel", namespaces=namespaces)[0]:
+        if child.tag != "item":
+            archive_channel.append(copy.deepcopy(child))
+    return etree.ElementTree(archive_root), archive_channel
+
+
+def select_latest_indices(channel_values):
+    """Return indices of the first item of each channel, items are expected to be sorted latest first."""
+    latest_indices = {}
+    for index, channel_value in enumerate(channel_values):
+        latest_indices.setdefault(channel_value, index)
+    return set(latest_indices.values())
+
+
+def write_etag(file_path: Path):
+    """Write a strong ETag of the file to a sidecar file, so that a CDN can answer conditional requests."""
+    digest = hashlib.sha256(file_path.read_bytes()).hexdigest()
+    etag_path = file_path.with_name(f"{file_path.name}.etag")
+    etag_path.write_text(f'"{digest}"', encoding=DEFAULT_ENCODING)
+
+
+def write_latest_feed(items, latest_path: Path, target_tree, namespaces):
+    """Write a feed with copies of the given items and the target channel metadata, and its ETag."""
+    latest_tree, latest_channel = create_channel_tree(target_tree, namespaces)
+    for item in items:
+        latest_channel.append(copy.deepcopy(item))
+
+    logging.info(f"Saving {len(items)} latest items to {latest_path}")
+    write_xml(latest_tree, latest_path)
+    write_etag(latest_path)
+
+
+def archive_items(items, archive_path: Path, target_tree, namespaces):
+    """Append items to the archive feed, a missing archive is created with the target channel metadata."""
+    if archive_path.exists():
+        logging.info(f"Loading archive XML file: {archive_path}")
+        archive_tree = load_xml(archive_path)
+        archive_channel = archive_tree.xpath("//rss/channel", namespaces=namespaces)[0]
+    else:
+        logging.info(f"Creating archive XML file: {archive_path}")
+        archive_tree, archive_channel = create_channel_tree(target_tree, namespaces)
+
+    for item in items:
+        archive_channel.append(item)
+
+    logging.info(f"Saving {len(items)} pruned items to {archive_path}")
+    write_xml(archive_tree, archive_path)
+
+
+def process_xml(
+    source_xml_path: Path,
+    target_xml_path: Path,
+    keep_per_channel: int = None,
+    max_age_days: int = None,
+    archive_path: Path = None,
+    stream: bool = False,
+    latest_path: Path = None,
+    metrics: Metrics = None,
+):
     """Process XML files, replace <item> elements with matching <sparkle:channel>, and sort by <pubDate>."""
-    logging.info(f"Loading source XML file: {source_xml_path}")
-    source_tree = load_xml(source_xml_path)
+    validate_prune_args(keep_per_channel, max_age_days)
+    metrics = metrics or Metrics("appcast")
+
+    if stream and process_xml_stream(
+        source_xml_path, target_xml_path, keep_per_channel, max_age_days, archive_path, latest_path, metrics=metrics
+    ):
+        return
 
-    logging.info(f"Loading target XML file: {target_xml_path}")
-    target_tree = load_xml(target_xml_path)
+    with metrics.phase("load"):
+        logging.info(f"Loading source XML file: {source_xml_path}")
+        source_tree = load_xml(source_xml_path)
+
+        logging.info(f"Loading target XML file: {target_xml_path}")
+        target_tree = load_xml(target_xml_path)
 
     # Define namespaces to be used in XPath queries
-    namespaces = {'sparkle': 'http://www.andymatuschak.org/xml-namespaces/sparkle'}
+    namespaces = {'sparkle': SPARKLE_NAMESPACE}
 
     # Get all <item> elements from the source XML using namespaces
     source_items = source_tree.xpath(ITEM_XPATH, namespaces=namespaces)
     if not source_items:
         logging.warning("No source <item> elements found!")
 
-    process_items(source_items, target_tree, namespaces)
+    with metrics.phase("transform"):
+        process_items(source_items, target_tree, namespaces)
 
     # Sort items in target XML by pubDate, in descending order
     logging.info("Sorting items in the target XML by <pubDate> (latest first)")
@@ -151,36 +540,457 @@ def process_xml(source_xml_path: Path, target_xml_path: Path):
     items = channel_element.xpath("item")
 
     # Sort items by pubDate, latest first
-    sorted_items = sorted(items, key=lambda item: parse_pubdate(item, namespaces), reverse=True)
+    with metrics.phase("sort"):
+        keyed_items = sort_items(items)
+    sorted_items = [item for _, item in keyed_items]
+    metrics.count("source_items", len(source_items))
+    metrics.count("items", len(items))
 
     # Remove existing <item> elements in the target XML
     for item in items:
         channel_element.remove(item)
 
+    pruned_items = []
+    if keep_per_channel is not None or max_age_days is not None:
+        pruned_indices = select_pruned_items(
+            [(pubdate_key, get_channel_value(item, namespaces) or None) for pubdate_key, item in keyed_items],
+            keep_per_channel,
+            max_age_days,
+        )
+        logging.info(f"Pruning {len(pruned_indices)} items by the retention policy")
+        metrics.count("pruned_items", len(pruned_indices))
+
+        pruned_items = [item for index, item in enumerate(sorted_items) if index in pruned_indices]
+        sorted_items = [item for index, item in enumerate(sorted_items) if index not in pruned_indices]
+
     # Add sorted items back to the channel, preserving CDATA
     for item in sorted_items:
-        cdata_content = preserve_cdata(item, namespaces)
-        if cdata_content:
-            release_notes_link = item.xpath("sparkle:releaseNotesLink", namespaces=namespaces)
-            if release_notes_link:
-                release_notes_link[0].text = etree.CDATA(cdata_content)
+        restore_cdata(item, namespaces)
         channel_element.append(item)
 
+    # The archive is written first, so a failure may duplicate pruned items but never lose them
+    if pruned_items and archive_path:
+        with metrics.phase("archive"):
+            archive_items(pruned_items, archive_path, target_tree, namespaces)
+        metrics.count_bytes([archive_path])
+
     # Save the modified target XML with preserved CDATA
     logging.info(f"Saving modified target XML to {target_xml_path}")
-    formatted_xml = format_xml(target_tree)
+    with metrics.phase("write"):
+        write_xml(target_tree, target_xml_path)
+    metrics.count_bytes([target_xml_path])
+
+    if latest_path:
+        with metrics.phase("latest"):
+            latest_indices = select_latest_indices(
+                [get_channel_value(item, namespaces) or None for item in sorted_items]
+            )
+            latest_items = [item for index, item in enumerate(sorted_items) if index in latest_indices]
+            write_latest_feed(latest_items, latest_path, target_tree, namespaces)
+        metrics.count("latest_items", len(latest_items))
+        metrics.count_bytes([latest_path])
+
+
+class ChannelItems:
+    """
+    Iterate <item> elements of a feed parsed incrementally, each item is removed from the tree once it is processed.
+    An item is given out after the next one is parsed, so that its tail is complete. After the iteration
+    `root` is the root of the whole feed without items.
+    """
+
+    def __init__(self, file_path: Path):
+        self.file_path = file_path
+        self.root = None
+
+    def __iter__(self):
+        context = etree.iterparse(str(self.file_path), events=("end",), tag="item")
+        previous = None
+        try:
+            for _, item in context:
+                if previous is not None:
+                    yield previous
+                    self.release(previous)
+                previous = item
+        except etree.XMLSyntaxError as e:
+            logging.error(f"Error parsing XML file {self.file_path}: {e}")
+            raise
+
+        if previous is not None:
+            yield previous
+            self.release(previous)
+
+        self.root = context.root
+
+    @staticmethod
+    def release(item):
+        parent = item.getparent()
+        if parent is not None:
+            parent.remove(item)
+
+
+def scan_feed(file_path: Path, namespaces):
+    """
+    Read pubDate keys and channel classes of the feed items without keeping them in memory.
+    A class groups items with the same channels, they are always replaced together.
+    Return None if the items aren't children of the single channel of the feed.
+    """
+    keys = array("d")
+    classes = array("l")
+    class_ids = {}
+    channel = None
+
+    items = ChannelItems(file_path)
+    for item in items:
+        parent = item.getparent()
+        if channel is None:
+            channel = parent
+        if parent is not channel or parent.tag != "channel" or parent.getparent() is None:
+            return None
+
+        keys.append(get_pubdate_key(item))
+        channel_class = (
+            frozenset(get_indexed_channels(item, namespaces)),
+            get_channel_value(item, namespaces) or None,
+        )
+        classes.append(class_ids.setdefault(channel_class, len(class_ids)))
+
+    tree = items.root.getroottree()
+    channels = tree.xpath("//rss/channel", namespaces=namespaces)
+    if not channels or (channel is not None and channels[0] is not channel):
+        return None
+
+    return keys, classes, list(class_ids), tree, channels[0]
+
+
+def scan_archive(file_path: Path, namespaces):
+    """
+    Return the archive tree without items and its channel element.
+    Return None if the channel has other nodes after items, pruned items are appended after them.
+    """
+    items = ChannelItems(file_path)
+    for item in items:
+        next_node = item.getnext()
+        if next_node is not None and next_node.tag != "item":
+            return None
+
+    tree = items.root.getroottree()
+    return tree, tree.xpath("//rss/channel", namespaces=namespaces)[0]
+
+
+def replay_replacements(channel_classes, source_items, namespaces):
+    """
+    Replay replace_or_add_item on classes of target items instead of items themselves.
+    Return indices of source items that finally replace each class (None if kept) and of appended items.
+    """
+    index = {}
+    slot_channels = []
+    holders = []
+
+    def add_slot(slot, channels):
+        for channel_value in channels:
+            index.setdefault(channel_value, {})[slot] = None
+
+    for indexed_channels, _ in channel_classes:
+        add_slot(len(holders), indexed_channels)
+        slot_channels.append(indexed_channels)
+        holders.append(None)
+
+    for source_index, source_item in enumerate(source_items):
+        channel_value = get_channel_value(source_item, namespaces)
+        source_channels = get_indexed_channels(source_item, namespaces)
+
+        slots = list(index.get(channel_value or None, {}))
+        if not slots:
+            logging.info(f"No matching item found. Adding new item{' with channel: ' + channel_value if channel_value else ''}")
+            slots = [len(holders)]
+            slot_channels.append(())
+            holders.append(None)
+        else:
+            logging.info(f"Replacing items{' with channel: ' + channel_value if channel_value else ''}")
+
+        for slot in slots:
+            for indexed_channel in slot_channels[slot]:
+                index[indexed_channel].pop(slot, None)
+            add_slot(slot, source_channels)
+            slot_channels[slot] = source_channels
+            holders[slot] = source_index
+
+    return holders[:len(channel_classes)], holders[len(channel_classes):]
+
+
+def split_skeleton(tree, channel, cdata_tags):
+    """Serialize a feed without items into the text before and after the items of its channel."""
+    marker = etree.SubElement(channel, ITEMS_MARKER_TAG)
+    output = io.StringIO()
+    write_tree(output, tree, cdata_tags)
+    channel.remove(marker)
+
+    head, tail = output.getvalue().split(f"<{ITEMS_MARKER_TAG}/>\n")
+    return head.rstrip(" "), tail
+
+
+def write_item(writer, item, indent, cdata_tags, parent_nsmap):
+    """Write an item and its tail the same way as a child of the channel."""
+    write_node(writer, item, indent, cdata_tags, parent_nsmap)
+    if item.tail:
+        writer.write(escape_data(f"{indent}{item.tail}\n"))
+
+
+def serialize_item(item, channel, indent, cdata_tags):
+    """Return the text of an item written as a child of the channel, the item is moved to the channel meanwhile."""
+    channel.append(item)
+    output = io.StringIO()
+    write_item(output, item, indent, cdata_tags, channel.nsmap)
+    channel.remove(item)
+    return output.getvalue()
+
+
+class FeedWriter:
+    """Write a feed to a temporary file next to it, items are written between the head and the tail of the feed."""
+
+    def __init__(self, file_path: Path, tree, channel, has_items: bool, cdata_tags):
+        self.file_path = file_path
+        self.tmp_path = get_tmp_path(file_path)
+        self.tree = tree
+        self.channel = channel
+        self.has_items = has_items
+        self.cdata_tags = cdata_tags
+        self.indent = INDENT * (len(list(channel.iterancestors())) + 1)
+        self._file = None
+        self._writer = None
+        self._tail = ""
+
+    def __enter__(self):
+        self._file = open(self.tmp_path, "w", encoding=DEFAULT_ENCODING)
+        self._writer = LineFilterWriter(self._file)
+        if self.has_items:
+            head, self._tail = split_skeleton(self.tree, self.channel, self.cdata_tags)
+            self._writer.write(head)
+        else:
+            write_tree(self._writer, self.tree, self.cdata_tags)
+        return self
+
+    def write(self, text):
+        self._writer.write(text)
+
+    def write_item(self, item):
+        write_item(self._writer, item, self.indent, self.cdata_tags, self.channel.nsmap)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._writer.write(self._tail)
+        self._writer.close()
+        self._file.close()
+        if exc_type is not None:
+            os.remove(self.tmp_path)
+
+    def commit(self):
+        os.replace(self.tmp_path, self.file_path)
+
+
+def process_xml_stream(
+    source_xml_path: Path,
+    target_xml_path: Path,
+    keep_per_channel: int = None,
+    max_age_days: int = None,
+    archive_path: Path = None,
+    latest_path: Path = None,
+    cdata_tags=frozenset({RELEASE_NOTES_TAG}),
+    metrics: Metrics = None,
+):
+    """
+    Merge the source into the target reading target items one by one, the output is the same as of process_xml.
+    The first pass collects pubDate keys and channels of target items, which is enough to know the resulting order.
+    The second pass writes items in that order, so the target items must be already sorted by <pubDate>.
+    Return False if the target can't be merged this way.
+    """
+    metrics = metrics or Metrics("appcast")
+
+    namespaces = {'sparkle': SPARKLE_NAMESPACE}
+
+    # Loading is the first pass over the target
+    with metrics.phase("load"):
+        logging.info(f"Loading source XML file: {source_xml_path}")
+        source_tree = load_xml(source_xml_path)
+
+        source_items = source_tree.xpath(ITEM_XPATH, namespaces=namespaces)
+        if not source_items:
+            logging.warning("No source <item> elements found!")
+
+        logging.info(f"Scanning target XML file: {target_xml_path}")
+        scan = scan_feed(target_xml_path, namespaces)
+
+    if scan is None:
+        logging.warning("Target items are not children of a single channel, falling back to the in-memory merge")
+        return False
+
+    keys, classes, channel_classes, target_tree, target_channel = scan
+    with metrics.phase("transform"):
+        class_holders, appended_holders = replay_replacements(channel_classes, source_items, namespaces)
+
+    source_keys = [get_pubdate_key(item) for item in source_items]
+    source_channels = [get_channel_value(item, namespaces) or None for item in source_items]
+
+    # Kept target items are written in the document order, which must be the sorted one
+    previous_key = float("inf")
+    for key, class_id in zip(keys, classes):
+        if class_holders[class_id] is None:
+            if key > previous_key:
+                logging.warning("Target items are not sorted by <pubDate>, falling back to the in-memory merge")
+                return False
+            previous_key = key
+
+    # Items before sorting: target items with replacements applied, then appended source items.
+    # Positions of target items are their indices in the target, a replaced one is the source item holding it
+    holders = [class_holders[class_id] for class_id in classes] + appended_holders
+    final_keys = [
+        keys[position] if holder is None else source_keys[holder]
+        for position, holder in enumerate(holders)
+    ]
+    logging.info("Sorting items in the target XML by <pubDate> (latest first)")
+    with metrics.phase("sort"):
+        order = sorted(range(len(holders)), key=final_keys.__getitem__, reverse=True)
+
+    def get_final_channel(position):
+        holder = holders[position]
+        return channel_classes[classes[position]][1] if holder is None else source_channels[holder]
+
+    pruned_indices = set()
+    if keep_per_channel is not None or max_age_days is not None:
+        pruned_indices = select_pruned_items(
+            [(final_keys[position], get_final_channel(position)) for position in order],
+            keep_per_channel,
+            max_age_days,
+        )
+        logging.info(f"Pruning {len(pruned_indices)} items by the retention policy")
+
+    # Latest items are selected among the kept ones, indices are the ones in the order
+    latest_indices = set()
+    latest_items = []
+    if latest_path:
+        kept_indices = [index for index in range(len(order)) if index not in pruned_indices]
+        latest_indices = {
+            kept_indices[index]
+            for index in select_latest_indices([get_final_channel(order[index]) for index in kept_indices])
+        }
+
+    archive = None
+    archive_channel = None
+    existing_archive_items = []
+    if pruned_indices and archive_path:
+        if archive_path.exists():
+            logging.info(f"Scanning archive XML file: {archive_path}")
+            archive_scan = scan_archive(archive_path, namespaces)
+            if archive_scan is None:
+                logging.warning("Archive items are not the last nodes of its channel, falling back to the in-memory merge")
+                return False
+            archive_tree, archive_channel = archive_scan
+            existing_archive_items = ChannelItems(archive_path)
+        else:
+            logging.info(f"Creating archive XML file: {archive_path}")
+            archive_tree, archive_channel = create_channel_tree(target_tree, namespaces)
+        archive = FeedWriter(archive_path, archive_tree, archive_channel, True, cdata_tags)
+
+    live = FeedWriter(target_xml_path, target_tree, target_channel, len(order) > len(pruned_indices), cdata_tags)
+
+    # Replacing items are copies of few source items, each one is serialized once
+    serialized_copies = {}
+
+    def write_copy(source_index, is_pruned, is_latest):
+        copy_key = (source_index, is_pruned)
+        if copy_key not in serialized_copies or is_latest:
+            new_item = copy.deepcopy(source_items[source_index])
+            target_channel.append(new_item)
+            if is_pruned:
+                text = serialize_item(new_item, archive_channel, archive.indent, cdata_tags)
+            else:
+                restore_cdata(new_item, namespaces)
+                text = serialize_item(new_item, target_channel, live.indent, cdata_tags)
+            serialized_copies[copy_key] = text
+
+            if is_latest:
+                latest_items.append(new_item)
+
+        (archive if is_pruned else live).write(serialized_copies[copy_key])
+
+    # Items are parsed, serialized and written in a single pass, so it is timed as a whole
+    with metrics.phase("write"), live, archive or contextlib.nullcontext():
+        # Pruned items are appended to the archive after its existing items
+        for archive_item in existing_archive_items:
+            archive.write_item(archive_item)
+
+        logging.info(f"Writing merged items from {target_xml_path}")
+        target_items = enumerate(ChannelItems(target_xml_path))
+        for order_index, position in enumerate(order):
+            is_pruned = order_index in pruned_indices
+            if is_pruned and not archive:
+                continue
+
+            is_latest = order_index in latest_indices
+            holder = holders[position]
+            if holder is not None:
+                write_copy(holder, is_pruned, is_latest)
+                continue
+
+            for item_position, item in target_items:
+                if item_position == position:
+                    break
+
+            if is_pruned:
+                archive.write(serialize_item(item, archive_channel, archive.indent, cdata_tags))
+            else:
+                restore_cdata(item, namespaces)
+                live.write_item(item)
+                if is_latest:
+                    latest_items.append(copy.deepcopy(item))
+
+        # Finish parsing, so the last item is released
+        for _ in target_items:
+            pass
+
+    # The archive is written first, so a failure may duplicate pruned items but never lose them
+    if archive:
+        logging.info(f"Saving {len(pruned_indices)} pruned items to {archive_path}")
+        archive.commit()
+        metrics.count_bytes([archive_path])
 
-    # Save the formatted XML to the target path
-    with open(target_xml_path, "w", encoding=DEFAULT_ENCODING) as f:
-        f.write(formatted_xml)
+    logging.info(f"Saving modified target XML to {target_xml_path}")
+    live.commit()
+    metrics.count_bytes([target_xml_path])
 
+    # Counted only now, as the merge may fall back to the in-memory one above
+    metrics.count("source_items", len(source_items))
+    metrics.count("items", len(keys))
+    if pruned_indices:
+        metrics.count("pruned_items", len(pruned_indices))
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if latest_path:
+        with metrics.phase("latest"):
+            write_latest_feed(latest_items, latest_path, target_tree, namespaces)
+        metrics.count("latest_items", len(latest_items))
+        metrics.count_bytes([latest_path])
+    return True
 
-    args = get_args()
+
+def main(argv=None):
+    args = get_args(argv)
 
     validate_file_exists(args.source_path, "Source XML")
     validate_file_exists(args.target_path, "Target XML")
 
-    process_xml(args.source_path, args.target_path)
+    with Metrics("appcast", args.metrics_path, args.profile_path, args.trace_memory) as metrics:
+        process_xml(
+            args.source_path,
+            args.target_path,
+            args.keep_per_channel,
+            args.max_age_days,
+            args.archive_path,
+            args.stream,
+            args.latest_path,
+            metrics,
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    main()